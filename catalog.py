@@ -0,0 +1,300 @@
+import os
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dash import dcc, Input, Output, State, no_update
+import pandas as pd
+
+import utils
+
+# Version of the index file layout, an index written with another version is rebuilt from scratch
+INDEX_VERSION = 1
+
+# Default directory scanned for the samples
+DEFAULT_DATA_PATH = os.path.join('..', 'data/export/')
+
+# Default location of the on-disk sample summary index
+DEFAULT_INDEX_PATH = os.path.join('..', 'data', 'cache', 'sample_index.json')
+
+# Below this number of files to parse, starting worker processes costs more than it saves
+MIN_FILES_PER_POOL = 8
+
+# The workers are started from a process running the MQTT, Flask and watcher threads, forking it could copy a lock held
+# by one of them, so they are started by a fork server (or spawned where there is none, on Windows)
+# The fork server imports this module once, its workers are forked with pandas already imported
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def get_mp_context():
+    context = multiprocessing.get_context(START_METHOD)
+    if START_METHOD == 'forkserver':
+        context.set_forkserver_preload([__name__])
+    return context
+
+# Columns of the per-sample table displayed by the world map and the timeline
+SUMMARY_COLUMNS = ['filename', 'Objects/ml', 'date', 'lat', 'lon', 'nb_objects']
+
+# Milliseconds between two checks of the catalog version by the clients of the world map and the timeline
+REFRESH_INTERVAL = 5000
+
+
+def get_value(df, column, default=1):
+    # Helper function to extract a value or return a default if not available
+    if column in df.columns and not df[column].empty:
+        try:
+            value = float(df[column].iloc[0])
+            return value if value else default
+        except (ValueError, TypeError):
+            return default
+    return default
+
+def get_first(df, column):
+    # Return the first value of a column as a plain python value (JSON serializable), None if not available
+    if column in df.columns and not df[column].empty:
+        value = df[column].iloc[0]
+        return value.item() if hasattr(value, 'item') else value
+    return None
+
+def summarize_tsv(tsv):
+    # Compute the summary of a sample from the header and the first object of its TSV file
+    df_temp, nb_objects, metadatas = utils.load_metadata(tsv)
+
+    acq_imaged_volume = get_value(df_temp, "acq_imaged_volume")
+    sample_dilution_factor = get_value(df_temp, "sample_dilution_factor")
+    sample_concentrated_sample_volume = get_value(df_temp, "sample_concentrated_sample_volume")
+    sample_total_volume = get_value(df_temp, "sample_total_volume")
+
+    filename = os.path.basename(tsv)
+    filename = filename.split("zip:")[-1]
+
+    return {
+        "filename": filename,
+        "Objects/ml": (nb_objects / acq_imaged_volume) * sample_dilution_factor * (sample_concentrated_sample_volume / (sample_total_volume * 1000)),
+        "date": get_first(df_temp, "acq_local_datetime"),
+        "lat": get_first(df_temp, "object_lat"),
+        "lon": get_first(df_temp, "object_lon"),
+        "nb_objects": nb_objects
+    }
+
+def safe_summarize_tsv(tsv):
+    # Return (summary, None) or (None, error) so that one corrupt file doesn't abort the whole catalog
+    try:
+        return summarize_tsv(tsv), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def summarize_tsvs(tsvs, workers=1):
+    # Summarize the TSV files, in parallel across worker processes if workers > 1 (None uses every core)
+    # Results are returned in the same order as tsvs
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(tsvs) >= MIN_FILES_PER_POOL:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tsvs)),
+                                     mp_context=get_mp_context()) as executor:
+                chunksize = max(1, len(tsvs) // (workers * 4))
+                return list(executor.map(safe_summarize_tsv, tsvs, chunksize=chunksize))
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            print(f"Parallel ingestion unavailable, falling back to serial: {e}")
+    return [safe_summarize_tsv(tsv) for tsv in tsvs]
+
+def catalog_dataframe(summaries):
+    # Create the per-sample DataFrame from a list of sample summaries
+    df = pd.DataFrame(summaries, columns=SUMMARY_COLUMNS)
+
+    # delete duplicates
+    df = df.drop_duplicates(keep='last').reset_index(drop=True)
+
+    # Transform the 'date' column to datetime format
+    df['date'] = pd.to_datetime(df['date'])
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+
+    return df
+
+def diff_catalogs(old, new):
+    # Compare two per-sample tables row by row, return the added, changed and removed filenames
+    # Missing values are compared as None since NaN never equals itself
+    old_rows = {row["filename"]: row for row in old.astype(object).where(old.notna(), None).to_dict('records')}
+    new_rows = {row["filename"]: row for row in new.astype(object).where(new.notna(), None).to_dict('records')}
+
+    added = [filename for filename in new_rows if filename not in old_rows]
+    removed = [filename for filename in old_rows if filename not in new_rows]
+    changed = [filename for filename in new_rows if filename in old_rows and new_rows[filename] != old_rows[filename]]
+    return added, changed, removed
+
+
+class SampleIndex:
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        # The index maps each TSV path to its signature (size, mtime, crc) and its sample summary
+        # and each ZIP archive to its signature (size, mtime) and its TSV entries, so unchanged archives are not reopened
+        self.index_path = index_path
+        self.entries, self.archives = self.load()
+
+    def load(self):
+        # Read the index from disk, an unreadable or outdated index is simply rebuilt
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+            return {}, {}
+        return data.get("entries", {}), data.get("archives", {})
+
+    def save(self):
+        # Write the index next to its final location then move it, so a crash never leaves a truncated index
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries, "archives": self.archives}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Failed to save sample index: {e}")
+
+    def update(self, path, workers=1):
+        # Scan the directory and return the summaries of all the samples, only new or changed files are parsed
+        # Also return whether any file was added, changed or removed since the last update
+        entries = {}
+        stale = []
+
+        archives = {zip_path: archive["signature"] for zip_path, archive in self.archives.items()}
+        for tsv, signature in utils.find_tsv_entries(path, self.archives):
+            entry = self.entries.get(tsv)
+            if entry is None or entry["signature"] != signature:
+                entry = {"signature": signature}
+                stale.append(tsv)
+            entries[tsv] = entry
+
+        # Parse the new or changed files, a file that fails is kept with its error so it is not retried until it changes
+        for tsv, (summary, error) in zip(stale, summarize_tsvs(stale, workers)):
+            entries[tsv]["summary"] = summary
+            if error is not None:
+                entries[tsv]["error"] = error
+                print(f"Failed to summarize {tsv}: {error}")
+
+        # Files removed from the directory are dropped from the index
+        modified = bool(stale) or entries.keys() != self.entries.keys()
+        if modified:
+            self.entries = entries
+        if modified or archives != {zip_path: archive["signature"] for zip_path, archive in self.archives.items()}:
+            self.save()
+
+        return [entry["summary"] for entry in entries.values() if entry["summary"] is not None], modified
+
+
+class SampleCatalog:
+    def __init__(self, path=DEFAULT_DATA_PATH, index_path=DEFAULT_INDEX_PATH, workers=1):
+        # Per-sample table shared by the world map and the timeline
+        # workers is the number of processes used to parse the files (None uses every core)
+        self.path = path
+        self.workers = workers
+        self.index = SampleIndex(index_path)
+        self.df = None
+        self.version = 0  # Incremented each time the table is replaced
+        self.listeners = []  # Called with (df, added, changed, removed) when the table is replaced
+        self.lock = threading.Lock()
+
+    def get_df(self):
+        # The table is computed once, on first use, and the same DataFrame is handed to every view
+        # The views must treat it as read-only
+        with self.lock:
+            if self.df is None:
+                summaries, modified = self.index.update(self.path, self.workers)
+                self.df = catalog_dataframe(summaries)
+            return self.df
+
+    def subscribe(self, listener):
+        # Register a function called when samples are added, changed or removed
+        self.listeners.append(listener)
+
+    def refresh(self):
+        # Rescan the directory, only the new or changed files are parsed
+        # The table is never modified in place: a new DataFrame replaces it and the listeners receive the affected filenames
+        with self.lock:
+            if self.df is None:
+                # Nothing computed yet, get_df will scan the directory when a view needs it
+                return
+            summaries, modified = self.index.update(self.path, self.workers)
+            if not modified:
+                return
+            df = catalog_dataframe(summaries)
+            added, changed, removed = diff_catalogs(self.df, df)
+            if not (added or changed or removed):
+                return
+            self.df = df
+            self.version += 1
+
+        print(f"Catalog updated: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+        for listener in self.listeners:
+            try:
+                listener(df, added, changed, removed)
+            except Exception as e:
+                print(f"Failed to update catalog view: {e}")
+
+
+class CatalogRefresh:
+    def __init__(self, graph_id, interval=REFRESH_INTERVAL):
+        # Keeps the clients of a catalog view (world map, timeline) up to date with the figure of the view
+        # The view calls push with its new figure and the patch bringing the previous version up to date (None if it has none)
+        # The clients check the version every interval milliseconds and receive the patch, or the whole figure if they
+        # missed several versions
+        self.graph_id = graph_id
+        self.interval = interval
+        self.update = (0, None, None)  # Version of the figure, its patch and the figure, replaced at once
+
+    @property
+    def version(self):
+        return self.update[0]
+
+    def push(self, fig, patch):
+        self.update = (self.update[0] + 1, patch, fig)
+
+    def current(self):
+        # The figure and its version, for the layout of a new page
+        version, patch, fig = self.update
+        return fig, version
+
+    def components(self, version):
+        # Components to add to the layout of the view, with the version of its figure
+        return [
+            dcc.Interval(id='catalog-refresh', interval=self.interval, n_intervals=0),  # Check for new samples
+            dcc.Store(id='catalog-version', data=version)
+        ]
+
+    def register_callbacks(self, app):
+        @app.callback(
+            Output(self.graph_id, 'figure', allow_duplicate=True),
+            Output('catalog-version', 'data', allow_duplicate=True),
+            Input('catalog-refresh', 'n_intervals'),
+            State('catalog-version', 'data'),
+            prevent_initial_call=True
+        )
+        def refresh(n_intervals, client_version):
+            # Send the samples added, changed or removed since the client last refreshed
+            version, patch, fig = self.update
+            if client_version == version:
+                return no_update, no_update
+            if client_version == version - 1 and patch is not None:
+                return patch, version
+            # The client missed several updates, send the whole figure
+            return fig, version
+
+
+class CatalogWatcher(threading.Thread):
+    def __init__(self, sample_catalog, interval=10):
+        # Poll the catalog directory every interval seconds, comparing sizes and modification times
+        super().__init__(daemon=True)
+        self.catalog = sample_catalog
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.catalog.refresh()
+            except Exception as e:
+                print(f"Failed to refresh catalog: {e}")
+
+    def stop(self):
+        self.stop_event.set()
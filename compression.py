@@ -0,0 +1,108 @@
+from flask import request
+import gzip
+import threading
+
+# Brotli compresses the Dash bundles and the figures better than gzip, without it only gzip is used
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Types of the responses that are compressed, the images (thumbnails) are already compressed
+COMPRESSED_MIMETYPES = {'application/json', 'application/javascript', 'text/javascript', 'text/html', 'text/css',
+                        'text/plain', 'image/svg+xml'}
+
+# Kind of each response in the byte counts, from the path of its request
+RESPONSE_TYPES = [
+    ('_dash-update-component', 'callback'),
+    ('_dash-layout', 'layout'),
+    ('_dash-dependencies', 'dependencies'),
+    ('_dash-component-suites', 'scripts'),
+    ('/thumbnails/', 'thumbnails'),
+]
+
+
+def response_type(path):
+    for part, kind in RESPONSE_TYPES:
+        if part in path:
+            return kind
+    return 'pages'
+
+
+class ResponseCompressor:
+    def __init__(self, min_size=500, level=6):
+        # after_request hook compressing the responses of a Flask server with brotli or gzip, whichever the browser accepts
+        # Responses smaller than min_size bytes are sent as they are, the compression wouldn't save a packet
+        # The scripts of the Dash packages never change while the server runs, they are compressed once at the highest level
+        # and kept, the layouts and callback responses are compressed on every request at level (1-9, gzip scale)
+        self.min_size = min_size
+        self.level = level
+        self.scripts = {}  # (path, encoding) to compressed body
+
+        # Bytes before and after the compression of each kind of response
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def register(self, flask_server):
+        flask_server.after_request(self)
+
+    def __call__(self, response):
+        kind = response_type(request.path)
+        if response.direct_passthrough or response.is_streamed:
+            # Files sent from the disk, their size isn't known here
+            self.count(kind, response.content_length or 0, response.content_length or 0)
+            return response
+
+        data = response.get_data()
+        encoding = self.encoding(response, data)
+        if encoding is None:
+            self.count(kind, len(data), len(data))
+            return response
+
+        if kind == 'scripts':
+            key = (request.path, encoding)
+            compressed = self.scripts.get(key)
+            if compressed is None:
+                compressed = self.compress(data, encoding, best=True)
+                self.scripts[key] = compressed
+        else:
+            compressed = self.compress(data, encoding)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        self.count(kind, len(data), len(compressed))
+        return response
+
+    def encoding(self, response, data):
+        # Encoding to use for the response, None to send it as it is
+        if response.status_code != 200 or 'Content-Encoding' in response.headers or len(data) < self.min_size:
+            return None
+        if response.mimetype not in COMPRESSED_MIMETYPES:
+            return None
+        if brotli is not None and request.accept_encodings['br']:
+            return 'br'
+        if request.accept_encodings['gzip']:
+            return 'gzip'
+        return None
+
+    def compress(self, data, encoding, best=False):
+        if encoding == 'br':
+            # Brotli quality goes up to 11, its levels 4-5 are as fast as gzip 6 for smaller results
+            return brotli.compress(data, quality=11 if best else min(self.level, 5))
+        return gzip.compress(data, compresslevel=9 if best else self.level)
+
+    def count(self, kind, raw, sent):
+        with self.lock:
+            counts = self.counts.setdefault(kind, {'responses': 0, 'raw_bytes': 0, 'sent_bytes': 0})
+            counts['responses'] += 1
+            counts['raw_bytes'] += raw
+            counts['sent_bytes'] += sent
+
+    def stats(self):
+        # Byte counts of each kind of response, with the ratio of the bytes saved
+        with self.lock:
+            stats = {kind: dict(counts) for kind, counts in self.counts.items()}
+        for counts in stats.values():
+            counts['saved'] = round(1 - counts['sent_bytes'] / counts['raw_bytes'], 3) if counts['raw_bytes'] else 0
+        return stats
@@ -13,6 +13,12 @@ import datatable as dp
 import infotable as ip
 import world_map as wm
 import timeline as tm
+import catalog as ct
+import dataset_cache as dc
+import thumbnails as th
+import zip_pool
+from dispatcher import CommandDispatcher
+from multiplexed_app import MultiplexedApp
 import utils as utils
 
 
@@ -42,12 +48,39 @@ It also respond to the frontend so it display the plots.
 """
 
 class VisualizationController:
-    def __init__(self, BROKER="localhost", MQTT_PORT=1883, FLASK_HOST="0.0.0.0", FLASK_PORT=5000, SUBSCRIBER="visualization/commands"):
+    def __init__(self, BROKER="localhost", MQTT_PORT=1883, FLASK_HOST="0.0.0.0", FLASK_PORT=5000, SUBSCRIBER="visualization/commands", CATALOG_WORKERS=None, WATCH_INTERVAL=10, CACHE_DIR=dc.DEFAULT_CACHE_DIR,
+                 CACHE_ENTRIES=4, CACHE_BYTES=256 * 1024 * 1024, COMPACT_DATASETS=False,
+                 COMMAND_WORKERS=4, HIST_SERVER_BINNING=True, SCATTER_MAX_POINTS=20000,
+                 THUMBNAIL_CACHE_BYTES=32 * 1024 * 1024, THUMBNAIL_DIR=None, MAX_OPEN_ZIPS=16,
+                 PREFETCH_THUMBNAILS=False, APP_POOL_SIZE=20, LAZY_APPS=False, APP_IDLE_TIMEOUT=300,
+                 MULTIPLEXED_PLOTS=False, SERVER_MODE="development", SERVER_THREADS=8, SERVER_CONNECTION_LIMIT=100,
+                 COMPRESS_RESPONSES=True):
         self.BROKER = BROKER  # MQTT BROKER address
         self.MQTT_PORT = MQTT_PORT  # MQTT BROKER port
         self.FLASK_HOST = FLASK_HOST # Flask server address that will be the base route for the iframe
         self.FLASK_PORT = FLASK_PORT # Flask server port
         self.SUBSCRIBER = SUBSCRIBER  # MQTT topic to subscribe to for commands
+        self.CATALOG_WORKERS = CATALOG_WORKERS  # Number of processes parsing the samples of the catalog (None uses every core, 1 is serial)
+        self.WATCH_INTERVAL = WATCH_INTERVAL  # Seconds between two scans of the export directory for new samples (None disables it)
+        self.CACHE_DIR = CACHE_DIR  # Directory of the on-disk cache of loaded datasets (None disables it)
+        self.CACHE_ENTRIES = CACHE_ENTRIES  # Number of loaded datasets kept in memory (None for no limit)
+        self.CACHE_BYTES = CACHE_BYTES  # Memory budget in bytes of the datasets kept in memory (None for no limit)
+        self.COMPACT_DATASETS = COMPACT_DATASETS  # Shrink the loaded datasets (float32 measurements, per-sample constants stored once)
+        self.COMMAND_WORKERS = COMMAND_WORKERS  # Number of threads running the received commands
+        self.HIST_SERVER_BINNING = HIST_SERVER_BINNING  # Bin the histograms on the server instead of sending every value
+        self.SCATTER_MAX_POINTS = SCATTER_MAX_POINTS  # Points sent by a scatter plot, larger datasets are downsampled (None sends every point)
+        self.THUMBNAIL_CACHE_BYTES = THUMBNAIL_CACHE_BYTES  # Memory budget in bytes of the hover thumbnails
+        self.THUMBNAIL_DIR = THUMBNAIL_DIR  # Directory where the thumbnails evicted from memory are written (None disables it)
+        self.MAX_OPEN_ZIPS = MAX_OPEN_ZIPS  # Number of ZIP archives kept open between two reads
+        self.PREFETCH_THUMBNAILS = PREFETCH_THUMBNAILS  # Make the thumbnails of a loaded dataset in the background
+        self.APP_POOL_SIZE = APP_POOL_SIZE  # Number of Dash apps, the least recently used plot is replaced when they are all used
+        self.LAZY_APPS = LAZY_APPS  # Create the Dash apps when they are first used instead of at startup
+        self.APP_IDLE_TIMEOUT = APP_IDLE_TIMEOUT  # Seconds after which an unused app is torn down in lazy mode (None keeps them)
+        self.MULTIPLEXED_PLOTS = MULTIPLEXED_PLOTS  # Display the scatter and hist plots with a single Dash app instead of one app per plot
+        self.SERVER_MODE = SERVER_MODE  # "development" (Werkzeug server) or "production" (waitress)
+        self.SERVER_THREADS = SERVER_THREADS  # Requests handled at the same time in production mode
+        self.SERVER_CONNECTION_LIMIT = SERVER_CONNECTION_LIMIT  # Connections accepted at the same time in production mode
+        self.COMPRESS_RESPONSES = COMPRESS_RESPONSES  # Compress the responses of the Flask server with brotli or gzip
 
         self.df = None  # Placeholder for the dataframe
         self.map = None # Placeholder for the map
@@ -55,6 +88,23 @@ class VisualizationController:
         self.data_table = None  # Placeholder for the data table visualization
         self.info_table = None  # Placeholder for the info table visualization
 
+        # Per-sample table shared by the world map and the timeline, computed once on first use
+        self.catalog = ct.SampleCatalog(workers=self.CATALOG_WORKERS)
+        self.watcher = None  # Thread keeping the catalog up to date, started by run
+
+        # On-disk cache of the typed datasets, a dataset is only parsed again when its file changes
+        self.dataset_cache = dc.DatasetCache(self.CACHE_DIR) if self.CACHE_DIR else None
+
+        # Last loaded datasets kept in memory, going back to one of them doesn't read it again
+        self.datasets = dc.DatasetLRU(max_entries=self.CACHE_ENTRIES, max_bytes=self.CACHE_BYTES)
+
+        # ZIP archives stay open between the catalog scans, the dataset loads and the hovers
+        zip_pool.pool.max_open = self.MAX_OPEN_ZIPS
+
+        # Thumbnails displayed when hovering the points of the scatter plots
+        self.thumbnails = th.ThumbnailCache(max_bytes=self.THUMBNAIL_CACHE_BYTES, spill_dir=self.THUMBNAIL_DIR)
+        self.prefetcher = None  # Thread making the thumbnails of the loaded dataset, replaced on each load
+
         # List of basic plots to create when a dataframe is loaded
         self.BASIC_PLOTS = [
             {"type": "hist", "x": "object_equivalent_diameter"},
@@ -63,6 +113,34 @@ class VisualizationController:
             {"type":"scatter", "x":"object_elongation", "y":"object_meansaturation"}
             ]
 
+        # Commands sharing a lane run in the order they were received, the other lanes run concurrently
+        # The catalog views don't depend on the loaded dataset, every other command does (load followed by plot...)
+        self.COMMAND_LANES = {
+            "create_world_map": "catalog",
+            "create_timeline": "catalog"
+        }
+        self.dispatcher = CommandDispatcher(workers=self.COMMAND_WORKERS)
+
+        # A newer load dataframe supersedes the pending and running ones, only the latest selection is loaded and plotted
+        # Each load gets a generation number when it is received, a load whose generation is not the latest one stops
+        self.COALESCED_COMMANDS = ["load_dataframe"]
+        self.load_generation = 0
+
+        # Commands that don't display anything, no app of the pool is taken for them
+        self.NO_APP_COMMANDS = ["load_dataframe", "clear_all"]
+
+        # Commands creating a plot, displayed by the multiplexed app in MULTIPLEXED_PLOTS mode
+        self.PLOT_COMMANDS = ["create_scatter_plot", "create_hist_plot"]
+
+        # Commands creating a view with its own app of the pool, pinned once created, and the attribute holding the view
+        # Once the view exists, the command displays it again without taking an app
+        self.VIEW_COMMANDS = {
+            "init_datatable": "data_table",
+            "init_infotable": "info_table",
+            "create_world_map": "map",
+            "create_timeline": "timeline"
+        }
+
         # Initialize MQTT client and set callback functions
         self.controller = mqtt.Client()
         self.controller.on_connect = self.on_connect
@@ -70,7 +148,20 @@ class VisualizationController:
         self.controller.on_publish = self.on_publish
 
         # Create The Flask server
-        self.server = FlaskServer(size=20)
+        # The scatter plot callbacks are registered once on every app and reused by the plots displayed by the app
+        # In MULTIPLEXED_PLOTS mode the pool only holds the views
+        pool_size = len(self.VIEW_COMMANDS) if self.MULTIPLEXED_PLOTS else self.APP_POOL_SIZE
+        self.server = FlaskServer(size=pool_size, thumbnail_cache=self.thumbnails,
+                                  templates=[sp.register_callbacks], on_release=self.on_app_released,
+                                  lazy=self.LAZY_APPS, idle_timeout=self.APP_IDLE_TIMEOUT,
+                                  compress=self.COMPRESS_RESPONSES)
+
+        # Apps of the plots: the pool of the server, or the slots of a single multiplexed app in MULTIPLEXED_PLOTS mode
+        # The map, the timeline and the tables always have their own app
+        if self.MULTIPLEXED_PLOTS:
+            self.plot_apps = MultiplexedApp(self.server, size=self.APP_POOL_SIZE, on_release=self.on_app_released)
+        else:
+            self.plot_apps = self.server
 
 
     def on_connect(self, controller, userdata, flags, rc):
@@ -87,13 +178,26 @@ class VisualizationController:
             args = message.get("args", [])
 
             print(f"Received command: command:{command}, args:{args}")
-            
-            app = self.server.get_available_app()
 
             # Dynamically call the method corresponding to the command
             method = getattr(self, command, None)
             if method:
-                method(controller, app, *args)
+                kwargs = {}
+                if command in self.COALESCED_COMMANDS:
+                    self.load_generation += 1
+                    kwargs["generation"] = self.load_generation
+
+                def execute():
+                    # Only the commands displaying something new take an app from the pool
+                    if command in self.NO_APP_COMMANDS or self.view_exists(command):
+                        method(controller, None, *args, **kwargs)
+                    else:
+                        pool = self.plot_apps if command in self.PLOT_COMMANDS else self.server
+                        self.run_with_app(pool, method, controller, *args, **kwargs)
+
+                # The command runs on a worker thread so the MQTT network loop is never blocked
+                self.dispatcher.submit(self.COMMAND_LANES.get(command, "dataset"), execute,
+                                       coalesce=command if command in self.COALESCED_COMMANDS else None)
             else:
                 print(f"Unknown command: {command}")
 
@@ -102,6 +206,22 @@ class VisualizationController:
         except Exception as e:
             print(f"Error processing command: {e}")
 
+    def view_exists(self, command):
+        # True if the command displays a view that was already created
+        return command in self.VIEW_COMMANDS and getattr(self, self.VIEW_COMMANDS[command]) is not None
+
+    def run_with_app(self, pool, method, controller, *args, **kwargs):
+        # Run a command with an app of the pool, the app can't be evicted by the other lanes while the view is built
+        app = pool.get_available_app()
+        try:
+            method(controller, app, *args, **kwargs)
+        finally:
+            if app.layout is pool.default_layout:
+                # The app wasn't used (the view already exists, invalid arguments, error...), give it back
+                pool.release(app.app_id)
+            else:
+                pool.ready(app.app_id)
+
     def clear_all(self, controller, app):
 
         # Reset tables
@@ -111,26 +231,50 @@ class VisualizationController:
         if self.info_table is not None:
             self.info_table.reset_df()
 
-        # Clear all the plots
-        for app_id in self.server.apps.keys():
-            app = self.server.apps[app_id]
-            if(app != self.map.app and app != self.data_table.app and app != self.timeline.app and app != self.info_table.app):
-                app.layout = self.server.default_layout
-                app.callback_map.clear()
-                if app_id in self.server.apps_running:
-                    self.server.apps_running.remove(app_id)
-                    base_url="http://"+str(self.FLASK_HOST)+":"+str(self.FLASK_PORT)
-                    msg={"command":"remove iframe","src":f"{base_url}{app.get_relative_path('')}"}
-                    self.controller.publish("visualization/chartPage", json.dumps(msg))
-                if app_id not in self.server.apps_available:
-                    self.server.apps_available.append(app_id)
+        # Clear all the plots, the map, the timeline and the tables are pinned and stay
+        released = self.server.release_all()
+        if self.plot_apps is not self.server:
+            released += self.plot_apps.release_all()
+        for app in released:
+            base_url="http://"+str(self.FLASK_HOST)+":"+str(self.FLASK_PORT)
+            msg={"command":"remove iframe","src":f"{base_url}{app.get_relative_path('')}"}
+            self.controller.publish("visualization/chartPage", json.dumps(msg))
 
+    def on_app_released(self, app):
+        # Called by the Flask server when a plot is closed or its app is given to a newer plot
+        msg = {"command": "remove iframe", "src": f"{app.get_relative_path('')}"}
+        self.controller.publish("visualization/chartPage", json.dumps(msg))
 
         
-    def load_dataframe(self, controller, app, filepath):
+    def is_superseded(self, generation):
+        # True if a newer load dataframe was received since the one with this generation
+        return generation is not None and generation != self.load_generation
+
+    def load_dataframe(self, controller, app, filepath, generation=None):
+        if self.is_superseded(generation):
+            print(f"Skipping superseded load of {filepath}")
+            return
+
+        # The thumbnails of the previous dataset won't be hovered anymore
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+        # Load dataframe and extract metadata, from memory if it was loaded recently
+        dataset = self.datasets.get(filepath)
+        if dataset is None:
+            if self.dataset_cache is not None:
+                dataset = self.dataset_cache.load(filepath, self.COMPACT_DATASETS)
+            else:
+                dataset = utils.load_dataframe(filepath, self.COMPACT_DATASETS)
+            self.datasets.put(filepath, *dataset)
+        print(f"Dataset cache: {self.datasets.stats()}")
 
-        # Load dataframe and extract metadata
-        self.df, number_of_object, metadatas_of_interest = utils.load_dataframe(filepath)
+        # The dataset stays cached but a newer selection will replace it, don't display it
+        if self.is_superseded(generation):
+            print(f"Skipping superseded load of {filepath}")
+            return
+        self.df, number_of_object, metadatas_of_interest = dataset
 
         # Set values in the data table if it exists
         if self.data_table is not None:
@@ -141,11 +285,16 @@ class VisualizationController:
             self.info_table.load_df(self.df)
 
         # Create default plots
-        self.create_defaults_plots(controller)
+        self.create_defaults_plots(controller, generation)
+
+        # Warm the thumbnail cache with the images the scatter plots can show, once the plots are created
+        if self.PREFETCH_THUMBNAILS and "img_file_name" in self.df.columns and not self.is_superseded(generation):
+            self.prefetcher = th.ThumbnailPrefetcher(self.thumbnails, filepath, self.df["img_file_name"].dropna().unique())
+            self.prefetcher.start()
 
         # Publish metadata
-        self.msg = {"command": "add metadata", "metadata": metadatas_of_interest}
-        controller.publish("visualization/chartPage", json.dumps(self.msg))
+        msg = {"command": "add metadata", "metadata": metadatas_of_interest}
+        controller.publish("visualization/chartPage", json.dumps(msg))
         print(f"DataFrame loaded from {filepath}")
 
     def create_scatter_plot(self, controller, app, x, y):
@@ -153,9 +302,10 @@ class VisualizationController:
             print(f"Invalid arguments for 'create scatter plot': {[x, y]}\nExample: {{'command': 'create scatter plot', 'args': ['x', 'y']}}")
         else:
             # Create a scatter plot with specified x and y columns
-            sp.ScatterPlot(controller, app, self.df, x, y)
-            self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-            controller.publish("visualization/chartPage", json.dumps(self.msg))
+            sp.ScatterPlot(controller, app, self.df, x, y, max_points=self.SCATTER_MAX_POINTS, thumbnail_cache=self.thumbnails,
+                           thumbnail_url=self.server.thumbnail_url)
+            msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+            controller.publish("visualization/chartPage", json.dumps(msg))
             print(f"Scatter plot created with x={x} and y={y}")
 
     def create_hist_plot(self, controller, app, x):
@@ -163,9 +313,9 @@ class VisualizationController:
             print(f"Invalid arguments for 'create hist plot': {x}\nExample: {{'command': 'create hist plot', 'args': ['x']}}")
         else:
             # Create a histogram plot for the specified column
-            hp.HistPlot(controller, app, self.df, x)
-            self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-            controller.publish("visualization/chartPage", json.dumps(self.msg))
+            hp.HistPlot(controller, app, self.df, x, server_binning=self.HIST_SERVER_BINNING)
+            msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+            controller.publish("visualization/chartPage", json.dumps(msg))
             print(f"Histogram plot created for {x}")
 
     def init_datatable(self, controller, app):
@@ -174,8 +324,9 @@ class VisualizationController:
         else:
             # Initialize the data table
             self.data_table = dp.DataTable(controller, app)
-        self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-        controller.publish("visualization/datatable", json.dumps(self.msg))
+            self.server.pin(app)  # Never evicted by newer plots
+        msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+        controller.publish("visualization/datatable", json.dumps(msg))
         print(f"Datatable created")
 
     def init_infotable(self, controller, app):
@@ -184,8 +335,9 @@ class VisualizationController:
         else:
             # Initialize the data table
             self.info_table = ip.InfoTable(controller, app)
-        self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-        controller.publish("visualization/infotable", json.dumps(self.msg))
+            self.server.pin(app)  # Never evicted by newer plots
+        msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+        controller.publish("visualization/infotable", json.dumps(msg))
         print(f"InfoTable created")
 
     def create_world_map(self, controller, app):
@@ -193,9 +345,10 @@ class VisualizationController:
         if(self.map is not None):
             app=self.map.app
         else:
-            self.map = wm.WorldMap(controller, app)
-        self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-        controller.publish("visualization/worldmap", json.dumps(self.msg))
+            self.map = wm.WorldMap(controller, app, self.catalog)
+            self.server.pin(app)  # Never evicted by newer plots
+        msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+        controller.publish("visualization/worldmap", json.dumps(msg))
         print(f"World map created")
 
     def create_timeline(self,controller,app):
@@ -203,22 +356,28 @@ class VisualizationController:
         if(self.timeline is not None):
             app=self.timeline.app
         else:
-            self.timeline=tm.Timeline(controller,app)
-        self.msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
-        controller.publish("visualization/timeline", json.dumps(self.msg))
+            self.timeline=tm.Timeline(controller,app,self.catalog)
+            self.server.pin(app)  # Never evicted by newer plots
+        msg = {"command": "add iframe", "src": f"{app.get_relative_path('/')}"}
+        controller.publish("visualization/timeline", json.dumps(msg))
         print(f"Timeline created")
 
-    def create_defaults_plots(self, controller):
+    def create_defaults_plots(self, controller, generation=None):
         for plot in self.BASIC_PLOTS:
-            
+            # Stop building the plots of a dataset replaced by a newer load
+            if self.is_superseded(generation):
+                print("Skipping default plots of a superseded dataset")
+                return
+
+            # A plot that fails gives its app back to the pool like the commands do
             if plot["type"] == "scatter":
                 try:
-                    self.create_scatter_plot(controller, self.server.get_available_app(), plot["x"], plot["y"])
+                    self.run_with_app(self.plot_apps, self.create_scatter_plot, controller, plot["x"], plot["y"])
                 except Exception as e:
                     print(f"Failed to create scatter plot: {e}")
             elif plot["type"] == "hist":
                 try:
-                    self.create_hist_plot(controller, self.server.get_available_app(), plot["x"])
+                    self.run_with_app(self.plot_apps, self.create_hist_plot, controller, plot["x"])
                 except Exception as e:
                     print(f"Failed to create histogram plot: {e}")
 
@@ -232,9 +391,15 @@ class VisualizationController:
             self.controller.connect(self.BROKER, self.MQTT_PORT, 60)
             self.controller_thread = threading.Thread(target=self.controller.loop_forever)
             self.server_thread = threading.Thread(target=self.server.run, kwargs={"debug": False, "use_reloader": False,
-                                                                                        "host": self.FLASK_HOST, "port": self.FLASK_PORT})
+                                                                                        "host": self.FLASK_HOST, "port": self.FLASK_PORT,
+                                                                                        "production": self.SERVER_MODE == "production",
+                                                                                        "threads": self.SERVER_THREADS,
+                                                                                        "connection_limit": self.SERVER_CONNECTION_LIMIT})
             self.controller_thread.start()
             self.server_thread.start()
+            if self.WATCH_INTERVAL:
+                self.watcher = ct.CatalogWatcher(self.catalog, self.WATCH_INTERVAL)
+                self.watcher.start()
         except Exception as e:
             print(f"Failed to start: {e}")
 
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+import utils
+
+# Feather files can be memory-mapped but need pyarrow, without it the frames are pickled
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+# Version of the cached frames, bumped whenever utils.load_dataframe returns differently typed frames
+CACHE_VERSION = 3
+
+# Default directory of the cached datasets
+DEFAULT_CACHE_DIR = os.path.join('..', 'data', 'cache', 'datasets')
+
+
+def source_signature(path):
+    # Size and modification time of the file holding the dataset (the archive for a TSV inside a ZIP)
+    if 'zip:' in path:
+        path = path.split('zip:', 1)[0] + 'zip'
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+class DatasetCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        # On-disk cache of the typed DataFrames returned by utils.load_dataframe
+        # A cached frame is used as long as the size and modification time of its source file are unchanged
+        self.cache_dir = cache_dir
+        self.format = 'feather' if feather is not None else 'pickle'
+
+    def entry_path(self, path):
+        # Each dataset path gets its own pair of files, a new version of the dataset overwrites them
+        key = hashlib.sha1(path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, path, compact=False):
+        # Same result as utils.load_dataframe, the TSV is only parsed if the cache is missing or outdated
+        signature = source_signature(path)
+        entry = self.read(path, signature, compact)
+        if entry is not None:
+            return entry
+
+        df, number_of_object, metadatas_of_interest = utils.load_dataframe(path, compact)
+        self.write(path, signature, compact, df, metadatas_of_interest)
+        return df, number_of_object, metadatas_of_interest
+
+    def read(self, path, signature, compact):
+        # Return the cached (df, number_of_object, metadatas_of_interest) or None
+        entry_path = self.entry_path(path)
+        try:
+            with open(entry_path + '.json', 'r') as f:
+                meta = json.load(f)
+            if meta.get("version") != CACHE_VERSION or meta["path"] != path or meta["signature"] != signature \
+                    or meta["format"] != self.format or meta["compact"] != compact:
+                return None
+
+            if self.format == 'feather':
+                df = feather.read_feather(entry_path + '.feather', memory_map=True)
+            else:
+                df = pd.read_pickle(entry_path + '.pkl')
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Failed to read cached dataset {path}: {e}")
+            return None
+
+        # The loaded frames are indexed from 1, the row 0 being the dropped [t]/[f] row
+        df = utils.CustomDataFrame(df)
+        df.index = pd.RangeIndex(1, len(df) + 1)
+        df.path = path
+        df.name = os.path.basename(path)
+        df.zip = 'zip:' in path
+        return df, len(df), meta["metadatas_of_interest"]
+
+    def write(self, path, signature, compact, df, metadatas_of_interest):
+        # Write the frame then its metadata, the metadata file marks the entry as complete
+        entry_path = self.entry_path(path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if self.format == 'feather':
+                # Uncompressed so that the file can be memory-mapped when read back
+                feather.write_feather(pd.DataFrame(df).reset_index(drop=True), entry_path + '.feather.tmp', compression='uncompressed')
+                os.replace(entry_path + '.feather.tmp', entry_path + '.feather')
+            else:
+                pd.DataFrame(df).reset_index(drop=True).to_pickle(entry_path + '.pkl.tmp')
+                os.replace(entry_path + '.pkl.tmp', entry_path + '.pkl')
+
+            meta = {"version": CACHE_VERSION, "path": path, "signature": signature, "format": self.format,
+                    "compact": compact, "metadatas_of_interest": metadatas_of_interest}
+            with open(entry_path + '.json.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(entry_path + '.json.tmp', entry_path + '.json')
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Failed to cache dataset {path}: {e}")
+
+
+class DatasetLRU:
+    def __init__(self, max_entries=4, max_bytes=256 * 1024 * 1024):
+        # In-memory cache of the last loaded datasets, bounded by a number of entries and a memory budget (None for no bound)
+        # Maps the dataset path to (signature, df, number_of_object, metadatas_of_interest, size in bytes)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        # Return (df, number_of_object, metadatas_of_interest) if the dataset is cached and its file unchanged, None otherwise
+        try:
+            signature = source_signature(path)
+        except OSError:
+            signature = None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1:4]
+
+            # The file changed since it was cached
+            if entry is not None:
+                self.remove(path)
+            self.misses += 1
+            return None
+
+    def put(self, path, df, number_of_object, metadatas_of_interest):
+        # Cache a loaded dataset, evicting other entries if the bounds are exceeded
+        size = int(df.memory_usage(deep=True).sum())
+        if self.max_bytes is not None and size > self.max_bytes:
+            print(f"Dataset {path} ({size} bytes) exceeds the cache budget, not cached")
+            return
+        try:
+            signature = source_signature(path)
+        except OSError:
+            return
+
+        with self.lock:
+            if path in self.entries:
+                self.remove(path)
+            self.entries[path] = (signature, df, number_of_object, metadatas_of_interest, size)
+            self.bytes += size
+            self.evict()
+
+    def remove(self, path):
+        # Must be called with the lock held
+        entry = self.entries.pop(path)
+        self.bytes -= entry[4]
+
+    def evict(self):
+        # Must be called with the lock held
+        # Too many entries: the least recently used are evicted first
+        while self.max_entries is not None and len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+        # Over the memory budget: the largest entries are evicted first, the most recent one is kept
+        while self.max_bytes is not None and self.bytes > self.max_bytes and len(self.entries) > 1:
+            most_recent = next(reversed(self.entries))
+            largest = max((path for path in self.entries if path != most_recent), key=lambda path: self.entries[path][4])
+            self.remove(largest)
+
+    def stats(self):
+        # Counters reported in the logs
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
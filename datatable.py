@@ -1,11 +1,51 @@
 import plotly.express as px
-from dash import Dash, dash_table, dcc, html, Input, Output, State, callback_context
+from dash import Dash, dash_table, dcc, html, Input, Output, State, callback_context, no_update
 import numpy as np
 import pandas as pd
 import threading
+import warnings
+
+# Number of values above which the quantiles of a column are estimated on a random sample of its values
+QUANTILE_SAMPLE_SIZE = 100000
+
+# Statistics that can be displayed as columns of the table, added with register_statistic
+STATISTICS = {}
+
+def register_statistic(name, function, quantiles=()):
+    # function(values, q) returns one value per column of values, the selected columns of the dataset as floats
+    # NaN values must be ignored (the pandas reductions skip them). q maps each of the given quantile levels to the
+    # quantiles of the columns, computed once for all the statistics of the table
+    STATISTICS[name] = (function, tuple(quantiles))
+
+register_statistic('mean', lambda values, q: values.mean())
+register_statistic('sd', lambda values, q: values.std(ddof=0))
+register_statistic('min', lambda values, q: values.min())
+register_statistic('max', lambda values, q: values.max())
+register_statistic('count', lambda values, q: values.count())
+register_statistic('cv', lambda values, q: values.std(ddof=0) / values.mean().replace(0, np.nan))
+register_statistic('median', lambda values, q: q[0.5], quantiles=[0.5])
+register_statistic('p5', lambda values, q: q[0.05], quantiles=[0.05])
+register_statistic('p95', lambda values, q: q[0.95], quantiles=[0.95])
+register_statistic('iqr', lambda values, q: q[0.75] - q[0.25], quantiles=[0.25, 0.75])
+
+def compute_quantiles(values, levels):
+    # All the quantile levels of all the columns in one pass, NaN values ignored
+    # Above QUANTILE_SAMPLE_SIZE rows they are estimated on a fixed-size random sample of the rows,
+    # the error on the rank of a percentile stays around 1/sqrt(QUANTILE_SAMPLE_SIZE)
+    array = values.to_numpy(dtype=float)
+    if len(array) > QUANTILE_SAMPLE_SIZE:
+        array = array[np.random.default_rng(0).choice(len(array), QUANTILE_SAMPLE_SIZE, replace=False)]
+    if not array.size:
+        # No column or no row, every quantile is missing
+        result = np.full((len(levels), array.shape[1]), np.nan)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # Columns without any value give NaN
+            result = np.nanquantile(array, levels, axis=0)
+    return {level: pd.Series(result[i], index=values.columns) for i, level in enumerate(levels)}
 
 class DataTable:
-    def __init__(self, controller, app, df=None):
+    def __init__(self, controller, app, df=None, columns=None):
         # Initialize the DataTable with a controller, Dash app, and optional DataFrame
         self.df_parent = df if df is not None else pd.DataFrame()
         self.controller = controller
@@ -21,24 +61,27 @@ class DataTable:
             "object_circex"
         ]
 
-        # Define default columns for the table
-        self.default_columns = [
+        # Define default columns for the table, any statistic of STATISTICS can be given or added from the table
+        self.default_columns = columns if columns is not None else [
             "mean",
             "min",
             "max",
             "sd"
         ]
 
-        # Map statistical operations to their corresponding methods
-        self.stats_operations = {
-            'mean': self.mean,
-            'sd': self.sd,
-            'min': self.min,
-            'max': self.max
-        }
+        # Map statistical operations to their computation, each one is done for all the rows at once
+        self.stats_operations = STATISTICS
+
+        # Statistics of the rows already computed for the loaded dataset, cleared when another dataset is loaded
+        self.stats_cache = {}
+
+        # Version of the table, bumped whenever self.df changes
+        # The clients check it every 2.5 seconds and only receive the table when they are not up to date
+        self.version = 0
 
         # Create the default DataFrame and table layout
         self.df = self.create_default_df()
+        self.options = self.get_options()
         self.create_table()
 
     def create_default_df(self):
@@ -51,16 +94,45 @@ class DataTable:
     def reset_df(self):
         # Reset the DataFrame to the default state
         self.df = self.create_default_df()
+        self.version += 1
 
     def load_df(self, df):
         # Load a new DataFrame and update the table
         self.df_parent = df
+        self.stats_cache = {}
+
+        df = self.df.copy()
+        rows = list(df["Morphology metrics"])
+        stats = [column for column in df.columns if column in self.stats_operations]
+        self.compute_stats(rows, stats)
+        for column in stats:
+            df[column] = [self.stats_cache[row][column] for row in rows]
+
+        # The table is replaced once complete, the dropdown options only change with the dataset
+        self.df = df
+        self.options = self.get_options()
+        self.version += 1
+
+    def compute_stats(self, rows, stats):
+        # Compute the statistics of the rows that are not in the cache yet, all of them in one vectorized pass
+        missing = [row for row in dict.fromkeys(rows) if any(stat not in self.stats_cache.get(row, {}) for stat in stats)]
+        if not missing:
+            return
+        stats = [stat for stat in stats if any(stat not in self.stats_cache.get(row, {}) for row in missing)]
+
+        # The values that aren't numbers are ignored like the missing ones, a column without any number gets empty cells
+        columns = [row for row in missing if row in self.df_parent.columns]
+        values = self.df_parent[columns].apply(pd.to_numeric, errors='coerce').astype(float)
+
+        levels = sorted({level for stat in stats for level in self.stats_operations[stat][1]})
+        quantiles = compute_quantiles(values, levels) if levels else {}
+        results = pd.DataFrame({stat: self.stats_operations[stat][0](values, quantiles) for stat in stats},
+                               index=values.columns).round(2)
+        results = results.astype(object).where(results.notna(), None)
 
-        for row_index, row in enumerate(self.df.iterrows()):
-            metadata = self.df["Morphology metrics"][row_index]
-            for col_index, (column, value) in enumerate(row[1].items()):
-                if column in self.stats_operations:
-                    self.df.loc[row_index, column] = self.stats_operations[column](metadata)
+        for row in missing:
+            row_stats = results.loc[row].to_dict() if row in results.index else dict.fromkeys(stats)
+            self.stats_cache.setdefault(row, {}).update(row_stats)
 
     def get_options(self):
         # Get the options for the dropdown menu
@@ -69,7 +141,8 @@ class DataTable:
 
     def create_layout(self):
         # Create the layout for the Dash app
-        self.metadatas_options = self.get_options()
+        self.metadatas_options = self.options
+        self.stats_options = [{'label': stat, 'value': stat} for stat in self.stats_operations]
 
         self.data_table = dash_table.DataTable(
             id='data-table',
@@ -93,7 +166,8 @@ class DataTable:
         )
 
         layout = html.Div([
-            dcc.Interval(id='interval', interval=2500, n_intervals=0),  # Refresh the table every 2.5 seconds
+            dcc.Interval(id='interval', interval=2500, n_intervals=0),  # Check for a new version of the table every 2.5 seconds
+            dcc.Store(id='table-version', data=self.version),
             html.Div([
                 html.Div([self.data_table], style={'flex': 3}),
             ], style={'display': 'flex', 
@@ -113,6 +187,19 @@ class DataTable:
                     style={'flex': 1,
                            'height': '90%'
                            }
+                ),
+                dcc.Dropdown(
+                    id='adding-columns-dropdown',
+                    options=self.stats_options,
+                    style={'flex': 2}
+                ),
+                html.Button(
+                    'Add Column',
+                    id='adding-columns-button',
+                    n_clicks=0,
+                    style={'flex': 1,
+                           'height': '90%'
+                           }
                 )
             ], style={'display': 'flex', 
                       'justify-content': 'flex-start', 
@@ -129,44 +216,66 @@ class DataTable:
 
         @self.app.callback(
             [Output('data-table', 'data', allow_duplicate=True),
-             Output('adding-rows-dropdown', 'options', allow_duplicate=True)],
+             Output('adding-rows-dropdown', 'options', allow_duplicate=True),
+             Output('table-version', 'data', allow_duplicate=True)],
             [Input('interval', 'n_intervals')],
+            [State('table-version', 'data')],
             prevent_initial_call=True
         )
-        def update_rows(n_intervals):
-            # Update the rows and options for the table
+        def update_rows(n_intervals, client_version):
+            # Update the rows and options for the table, only if they changed since the client last received them
+            version = self.version
+            if client_version == version:
+                return no_update, no_update, no_update
             rows = self.df.to_dict('records')
-            options = self.get_options()
-            return rows, options
+            return rows, self.options, version
 
         @self.app.callback(
             [Output('data-table', 'columns'), 
              Output('data-table', 'data'), 
-             Output('adding-rows-dropdown', 'options')],
-            [Input('adding-rows-button', 'n_clicks')],
+             Output('adding-rows-dropdown', 'options'),
+             Output('table-version', 'data')],
+            [Input('adding-rows-button', 'n_clicks'),
+             Input('adding-columns-button', 'n_clicks')],
             [State('data-table', 'data'),
              State('data-table', 'columns'),
-             State('adding-rows-dropdown', 'value')]
+             State('adding-rows-dropdown', 'value'),
+             State('adding-columns-dropdown', 'value')]
         )
-        def update_table(n_clicks_add_row, rows, columns, row_to_add):
-            # Update the table when a new row is added
+        def update_table(n_clicks_add_row, n_clicks_add_column, rows, columns, row_to_add, column_to_add):
+            # Update the table when a new row or a new statistic is added
             trigger = callback_context.triggered[0]['prop_id'].split('.')[0]
             print(f"Trigger: {trigger}")
 
+            if trigger == 'adding-columns-button' and n_clicks_add_column > 0 and column_to_add is not None:
+                if column_to_add not in [col['id'] for col in columns]:
+                    table_rows = [row['Morphology metrics'] for row in rows]
+                    self.compute_stats(table_rows, [column_to_add])
+                    for row in rows:
+                        row[column_to_add] = self.stats_cache[row['Morphology metrics']][column_to_add]
+                    columns.append({'name': column_to_add, 'id': column_to_add, 'deletable': True, 'renamable': False})
+
+                    # Adding to the df
+                    self.df = pd.DataFrame(rows, columns=[col['id'] for col in columns])
+                    self.version += 1
+
+                return columns, rows, self.options, self.version
+
             if trigger == 'adding-rows-button' and n_clicks_add_row > 0 and row_to_add is not None:
                 new_row = {'Morphology metrics': row_to_add}
+                self.compute_stats([row_to_add], [col['id'] for col in columns if col['id'] in self.stats_operations])
                 for col in columns:
                     if col['id'] != 'Morphology metrics':
-                        new_row[col['id']] = self.stats_operations[col['id']](row_to_add) if col['id'] in self.stats_operations else None
+                        new_row[col['id']] = self.stats_cache[row_to_add][col['id']] if col['id'] in self.stats_operations else None
                 rows.append(new_row)
-                options = self.get_options()
                 
                 # Adding to the df
                 self.df = pd.DataFrame(rows)
+                self.version += 1
 
-                return columns, rows, options
+                return columns, rows, self.options, self.version
 
-            return columns, rows, self.metadatas_options
+            return columns, rows, self.metadatas_options, no_update
 
         @self.app.callback(
             Input('data-table', 'data_previous'),
@@ -176,42 +285,7 @@ class DataTable:
             if previous:
                 # Update DataFrame to match the current state of the DataTable
                 self.df = pd.DataFrame(current)
-
-    def mean(self, col):
-        # Calculate the mean of a column
-        if not (self.df_parent[col].dtype in [np.float64, np.int64]):
-            try:
-                return round(np.mean(self.df_parent[col].astype(float)), 2)
-            except ValueError:
-                return 0
-        return round(np.mean(self.df_parent[col]), 2)
-
-    def sd(self, col):
-        # Calculate the standard deviation of a column
-        if not (self.df_parent[col].dtype in [np.float64, np.int64]):
-            try:
-                return round(np.std(self.df_parent[col].astype(float)), 2)
-            except ValueError:
-                return 0
-        return round(np.std(self.df_parent[col]), 2)
-
-    def min(self, col):
-        # Calculate the minimum value of a column
-        if not (self.df_parent[col].dtype in [np.float64, np.int64]):
-            try:
-                return round(np.min(self.df_parent[col].astype(float)), 2)
-            except ValueError:
-                return 0
-        return round(np.min(self.df_parent[col]), 2)
-
-    def max(self, col):
-        # Calculate the maximum value of a column
-        if not (self.df_parent[col].dtype in [np.float64, np.int64]):
-            try:
-                return round(np.max(self.df_parent[col].astype(float)), 2)
-            except ValueError:
-                return 0
-        return round(np.max(self.df_parent[col]), 2)
+                self.version += 1
 
 if __name__ == '__main__':
     import pandas as pd
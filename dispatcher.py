@@ -0,0 +1,48 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CommandDispatcher:
+    def __init__(self, workers=4):
+        # Run the commands on a pool of worker threads so the MQTT network loop only decodes and enqueues them
+        # Commands are grouped in lanes: the commands of a lane run one after another in the order they were submitted,
+        # different lanes run concurrently
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+        self.lanes = {}  # Pending commands of each lane that has a command running
+        self.lock = threading.Lock()
+
+    def submit(self, lane, function, *args, coalesce=None):
+        # Queue the command behind the ones of its lane, or start it right away if the lane is idle
+        # With a coalesce key, the pending commands of the lane with the same key are dropped: only the latest one runs
+        with self.lock:
+            pending = self.lanes.get(lane)
+            if pending is not None:
+                if coalesce is not None:
+                    superseded = [command for command in pending if command[2] == coalesce]
+                    for command in superseded:
+                        pending.remove(command)
+                    if superseded:
+                        print(f"Skipping {len(superseded)} superseded '{coalesce}' command(s)")
+                pending.append((function, args, coalesce))
+                return
+            self.lanes[lane] = deque()
+        self.executor.submit(self.run_lane, lane, function, args)
+
+    def run_lane(self, lane, function, args):
+        # Run the command then the ones queued behind it in the same lane
+        while True:
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"Error processing command: {e}")
+
+            with self.lock:
+                pending = self.lanes[lane]
+                if not pending:
+                    del self.lanes[lane]
+                    return
+                function, args, coalesce = pending.popleft()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
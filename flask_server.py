@@ -1,10 +1,48 @@
-from flask import Flask, url_for, request
-from dash import Dash, html
+from flask import Flask, url_for, request, Response
+from dash import Dash, html, Input
+from urllib.parse import quote
+import hashlib
+import os
+import re
+import threading
+import time
+
+import thumbnails
+from compression import ResponseCompressor
+from dataset_cache import source_signature
+
+# Production WSGI server, without it the Werkzeug development server is used
+try:
+    import waitress
+except ImportError:
+    waitress = None
 
 class FlaskServer():
-    def __init__(self, size=20):
+    def __init__(self, size=20, thumbnail_cache=None, templates=(), on_release=None, lazy=False, idle_timeout=None,
+                 compress=True):
         # Initialize the FlaskServer with a given size (number of Dash apps)
         self.size = size
+
+        # In lazy mode an app is only created when it is first handed out, with its own Flask server mounted under
+        # /app{i}/ (a Flask server can't get new routes once it has handled a request), and the apps given back to the
+        # pool are torn down after idle_timeout seconds without requests (None keeps them)
+        self.lazy = lazy
+        self.idle_timeout = idle_timeout
+
+        # Callback templates registered once on every app of the pool, template(app) registers callbacks that run the
+        # methods of the plot displayed by the app (app.plot), so a recycled app never registers callbacks again
+        self.templates = templates
+
+        # Called with the app when it is taken back from its plot (close button, eviction), to remove its iframe
+        self.on_release = on_release
+
+        # With compress, the responses are compressed with brotli or gzip and their bytes counted by type (/apps/stats)
+        self.compressor = ResponseCompressor() if compress else None
+
+        # Thumbnails served by the /thumbnails route (None makes them on every request)
+        # Only the images of the datasets registered by thumbnail_url can be requested
+        self.thumbnails = thumbnail_cache
+        self.datasets = {}
         self.default_layout = html.Div(id='dash-container', children=[
             html.H1(f"Hello Dash"), html.Br(), html.H2("Nothing running here...")
         ])
@@ -14,23 +52,28 @@ class FlaskServer():
         self.apps = {}
         self.apps_running = []
         self.apps_available = []
+        self.apps_pinned = set()  # Apps never evicted (map, timeline, tables)
+        self.apps_building = set()  # Apps handed out whose view is being built, not evicted until ready or release
+        self.last_access = {}  # time.monotonic() of the last request to each app
+        self.lock = threading.Lock()  # Protects the pool lists, the apps are handed out from several command threads
         self.init_flask_server()  # Create a Flask server with a number of empty apps defined by self.size
 
     def init_flask_server(self):
         # Create the Flask server
         self.server = Flask(import_name="Visualization Server")
+        if self.compressor is not None:
+            self.compressor.register(self.server)
 
         # Initialize Dash apps and add them to the server
         for i in range(self.size):
-            app = Dash(
-                f"app{i}",
-                server=self.server,
-                url_base_pathname=f'/app{i}/'
-            )
-            app.layout = self.default_layout
-            self.apps[i] = app
+            if not self.lazy:
+                self.apps[i] = self.create_app(i)
             self.apps_available.append(i)
 
+        # The requests to the apps go through dispatch
+        self.flask_wsgi_app = self.server.wsgi_app
+        self.server.wsgi_app = self.dispatch
+
         # Define the root route
         @self.server.route('/')
         def index():
@@ -41,26 +84,57 @@ class FlaskServer():
         def list_apps():
             app_links = [
                 f'<a href="{url_for("serve_dash_app", app_id=app_id)}">App {app_id} {"Running" if app_id in self.apps_running else ""}</a>'
-                for app_id in self.apps.keys()
+                for app_id in range(self.size)
             ]
             return '<br>'.join(app_links)
 
+        # Define the route reporting the bytes sent by type of response, before and after the compression
+        @self.server.route('/apps/stats')
+        def apps_stats():
+            return self.compressor.stats() if self.compressor is not None else {}
+
         # Define the route to shutdown/reset an app
         # This route is called by the Dash app itself when the close button is clicked
         @self.server.route('/apps/shutdown', methods=['POST'])
         def app_shutdown():
             app_id = request.form.get('app_id', type=int)
-            app = self.apps.get(app_id)
-            if app:
-                app.layout = self.default_layout
-                app.callback_map.clear()
-                if app_id in self.apps_running:
-                    self.apps_running.remove(app_id)
-                if app_id not in self.apps_available:
-                    self.apps_available.append(app_id)
+            if app_id in self.apps:
+                self.release(app_id)
                 return f"App {app_id} has been reset.", 200
             return f"App {app_id} not found.", 404
 
+        # Define the route serving the thumbnail of an object image
+        # The browser caches it and revalidates it with its ETag, a repeated hover costs a 304 at most
+        @self.server.route('/thumbnails/<dataset_id>/<path:img_file_name>')
+        def serve_thumbnail(dataset_id, img_file_name):
+            dataset_path = self.datasets.get(dataset_id)
+            if dataset_path is None:
+                return f"Dataset {dataset_id} not found.", 404
+            if os.path.isabs(img_file_name) or os.path.normpath(img_file_name).startswith('..'):
+                return f"Image {img_file_name} not found.", 404
+
+            try:
+                signature = source_signature(dataset_path)
+            except OSError:
+                return f"Dataset {dataset_id} not found.", 404
+            etag = hashlib.sha1(f"{dataset_path}\0{signature}\0{img_file_name}".encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                try:
+                    if self.thumbnails is not None:
+                        thumbnail = self.thumbnails.get(dataset_path, img_file_name)
+                    else:
+                        thumbnail = thumbnails.make_thumbnail(dataset_path, img_file_name)
+                except (OSError, KeyError) as e:
+                    return f"Image {img_file_name} not found: {e}", 404
+                response = Response(thumbnail, mimetype='image/jpeg')
+
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.max_age = 24 * 3600
+            return response
+
         # Define the route to serve a specific Dash app
         @self.server.route('/app/<int:app_id>')
         def serve_dash_app(app_id):
@@ -69,21 +143,146 @@ class FlaskServer():
                 return app.index()
             return f"App {app_id} not found.", 404
 
+    def thumbnail_url(self, dataset_path, img_file_name):
+        # URL of the thumbnail of an object image, registering its dataset so the route can serve it
+        dataset_id = hashlib.sha1(dataset_path.encode()).hexdigest()[:16]
+        self.datasets[dataset_id] = dataset_path
+        return f"/thumbnails/{dataset_id}/{quote(img_file_name)}"
+
+    def create_app(self, i):
+        # Create the Dash app i, on the Flask server or on its own one in lazy mode
+        app = Dash(
+            f"app{i}",
+            server=self.server if not self.lazy else True,
+            url_base_pathname=f'/app{i}/'
+        )
+        if self.lazy and self.compressor is not None:
+            self.compressor.register(app.server)
+        app.layout = self.default_layout
+        app.app_id = i
+        app.plot = None
+        self.register_templates(app)
+        return app
+
+    def dispatch(self, environ, start_response):
+        # WSGI entry point: record the last access of each app (its page and its callbacks)
+        # and hand the requests of the apps having their own Flask server to it
+        match = re.match(r'/app(\d+)/', environ.get('PATH_INFO', ''))
+        if match:
+            app_id = int(match.group(1))
+            self.last_access[app_id] = time.monotonic()
+            app = self.apps.get(app_id)
+            if app is not None and app.server is not self.server:
+                return app.server.wsgi_app(environ, start_response)
+        return self.flask_wsgi_app(environ, start_response)
+
+    def teardown_idle_apps(self):
+        # Lazy mode: drop the apps given back to the pool that had no request for idle_timeout seconds
+        now = time.monotonic()
+        with self.lock:
+            idle = [i for i in self.apps_available
+                    if i in self.apps and now - self.last_access.get(i, 0) > self.idle_timeout]
+            for i in idle:
+                del self.apps[i]
+        if idle:
+            print(f"Tore down idle apps {idle}")
+
+    def watch_idle_apps(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            self.teardown_idle_apps()
+
+    def register_templates(self, app):
+        # Close button of the plots, the app goes back to the pool
+        @app.callback(
+            Input('stop-button', 'n_clicks'),
+            prevent_initial_call=True
+        )
+        def shutdown(n_clicks):
+            print(f"Shutting down app {app.app_id}")
+            if self.release(app.app_id) and self.on_release is not None:
+                self.on_release(app)
+
+        for template in self.templates:
+            template(app)
+
     def get_available_app(self):
         # Get an available app from the pool
-        if not self.apps_available:
-            # If no available apps, move the oldest running app to the end of the list
-            app = self.apps_running[4]
-            self.apps_running.remove(app)
-            self.apps_running.append(app)
-            return self.apps[app]
-            
-        i = self.apps_available.pop(0)
-        self.apps_running.append(i)
+        evicted = None
+        with self.lock:
+            if self.apps_available:
+                i = self.apps_available.pop(0)
+            else:
+                # If no available apps, evict the least recently used running app that is not pinned
+                candidates = [i for i in self.apps_running if i not in self.apps_pinned and i not in self.apps_building]
+                if not candidates:
+                    raise RuntimeError("No app available, every app of the pool is pinned or being built")
+                i = min(candidates, key=lambda i: self.last_access.get(i, 0))
+                self.apps_running.remove(i)
+                evicted = self.apps[i]
+                # The app is handed out like an available one, the plot it displayed is gone
+                evicted.layout = self.default_layout
+                evicted.plot = None
+                print(f"Evicting app {i}")
+            self.apps_running.append(i)
+            self.apps_building.add(i)
+            self.last_access[i] = time.monotonic()
+
+        if evicted is not None and self.on_release is not None:
+            self.on_release(evicted)
+
+        # Created outside of the lock, the app is running so it is neither handed out nor torn down meanwhile
+        if i not in self.apps:
+            self.apps[i] = self.create_app(i)
         return self.apps[i]
 
-    def run(self, **kwargs):
+    def ready(self, app_id):
+        # The view of the app is built, it can be evicted again unless it is pinned
+        with self.lock:
+            self.apps_building.discard(app_id)
+
+    def pin(self, app):
+        # Keep the app out of the eviction, for the views that are created once (map, timeline, tables)
+        with self.lock:
+            self.apps_pinned.add(app.app_id)
+
+    def release(self, app_id):
+        # Give a running app back to the pool, its callbacks stay registered for the next plot
+        # Return False if the app is unknown or not running
+        app = self.apps.get(app_id)
+        if app is None:
+            return False
+        with self.lock:
+            running = app_id in self.apps_running
+            app.layout = self.default_layout
+            app.plot = None
+            if running:
+                self.apps_running.remove(app_id)
+            if app_id not in self.apps_available:
+                self.apps_available.append(app_id)
+            self.apps_pinned.discard(app_id)
+            self.apps_building.discard(app_id)
+        return running
+
+    def release_all(self):
+        # Give every running app that is not pinned back to the pool and return them
+        with self.lock:
+            app_ids = [i for i in self.apps_running if i not in self.apps_pinned]
+        return [self.apps[i] for i in app_ids if self.release(i)]
+
+    def run(self, production=False, threads=8, connection_limit=100, **kwargs):
         # Run the Flask server with the given arguments
+        # With production, the server is run by waitress: threads requests are handled at the same time and at most
+        # connection_limit connections are accepted, the other ones wait in the listen queue
+        if self.lazy and self.idle_timeout:
+            threading.Thread(target=self.watch_idle_apps, daemon=True).start()
+
+        if production:
+            if waitress is not None:
+                waitress.serve(self.server, host=kwargs.get("host", "127.0.0.1"), port=kwargs.get("port", 5000),
+                               threads=threads, connection_limit=connection_limit)
+                return
+            print("waitress is not installed (pip install waitress), running the development server")
         self.server.run(**kwargs)
 
 if __name__ == "__main__":
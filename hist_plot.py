@@ -1,19 +1,25 @@
 import plotly.express as px
-from dash import Dash, dcc, html, Input, Output
-import json
-import requests
-import re
-from flask import request
+import plotly.graph_objects as go
+from dash import Dash, dcc, html, Output
+import numpy as np
+import pandas as pd
 
 import utils as utils
 
 
+# Upper bound of the number of bins computed on the server
+MAX_BINS = 100
+
 class HistPlot:
-    def __init__(self,controller,app, df, x):
+    def __init__(self,controller,app, df, x, server_binning=False):
         self.controller = controller
         self.app=app
         self.df = df
         self.x = x
+
+        # With server_binning the bins are computed here and only one bar per bin is sent to the browser,
+        # otherwise every value is sent and binned by plotly.js
+        self.server_binning = server_binning
         
 
         self.publisher = "visualization/chartPage"
@@ -27,9 +33,69 @@ class HistPlot:
         self.hist_plot()
 
     def create_hist_fig(self):
+        if self.server_binning:
+            fig, normalization_buttons = self.create_binned_hist_fig()
+        else:
+            fig, normalization_buttons = self.create_raw_hist_fig()
+
+        return self.add_buttons(fig, normalization_buttons)
+
+    def get_values(self):
+        # Finite values of the column as a float array
+        column = self.df[self.x]
+        if pd.api.types.is_numeric_dtype(column):
+            values = column.to_numpy(dtype=float, na_value=np.nan)
+        else:
+            values = pd.to_numeric(column.astype(object), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        return values[np.isfinite(values)]
+
+    def create_binned_hist_fig(self):
+        # Bin the values with NumPy, the size of the figure doesn't depend on the number of objects
+        values = self.get_values()
+        edges = np.histogram_bin_edges(values, bins='auto') if len(values) else np.array([0.0, 1.0])
+        if len(edges) > MAX_BINS + 1:
+            edges = np.histogram_bin_edges(values, bins=MAX_BINS)
+        counts, edges = np.histogram(values, bins=edges)
+        percentages = counts / counts.sum() * 100 if counts.sum() else counts.astype(float)
+        counts, percentages = utils.compact_array(counts), utils.compact_array(percentages)
+
+        fig = go.Figure(go.Bar(
+            x=(edges[:-1] + edges[1:]) / 2,
+            y=counts,
+            width=np.diff(edges),
+            customdata=np.column_stack([edges[:-1], edges[1:]]),
+            hovertemplate=f"{self.x}=%{{customdata[0]:.4g}} - %{{customdata[1]:.4g}}<br>%{{y}}<extra></extra>",
+            marker_color='#a3a7e4'
+        ))
+        fig.update_layout(title=self.df.name, bargap=0, xaxis_title=self.x, yaxis_title='count')
+        utils.compact_figure(fig)
+
+        # The normalization buttons swap the precomputed bar heights
+        normalization_buttons = [
+            {
+                'label': 'Count',
+                'method': 'update',
+                'args': [
+                    {'y': [counts]},  # Update the bar heights
+                    {'yaxis': {'title': 'Count'}}  # Update the y-axis title
+                ]
+            },
+            {
+                'label': 'Percentage',
+                'method': 'update',
+                'args': [
+                    {'y': [percentages]},  # Update the bar heights
+                    {'yaxis': {'title': 'Percentage'}}  # Update the y-axis title
+                ]
+            }
+        ]
+        return fig, normalization_buttons
+
+    def create_raw_hist_fig(self):
         # Create a Plotly Express histogram
         fig = px.histogram(data_frame=self.df, x=self.x,title=self.df.name)
         fig.update_traces(marker_color='#a3a7e4')
+        utils.compact_figure(fig)
 
         # Create buttons for standard units and percentages
         normalization_buttons = [
@@ -50,7 +116,9 @@ class HistPlot:
                 ]
             }
         ]
+        return fig, normalization_buttons
 
+    def add_buttons(self, fig, normalization_buttons):
         # Create buttons for linear and log scale
         scale_buttons = [
             {
@@ -101,9 +169,9 @@ class HistPlot:
 
     def hist_plot(self):
         fig = self.create_hist_fig()
-        
-
 
+        # The close button is handled by the callback template registered by the Flask server on every app
+        self.app.plot = self
         self.app.layout = html.Div([
             dcc.Graph(id='hist-plot', figure=fig, config=self.config),
             html.Div(id='output-div'),
@@ -114,30 +182,6 @@ class HistPlot:
             style={'position': 'relative', 'width': '100%', 'height': '100%'}
         )
 
-        
-        @self.app.callback(
-        Input('stop-button', 'n_clicks')
-        )
-        def shutdown(n_clicks):
-
-            # Use regular expression to find app_id
-            match = re.search(r'.*(\d+)/', self.app.config['requests_pathname_prefix'])
-            if match:
-                app_id = match.group(1)
-                print(f"Shutting down app {app_id}")
-                # Get the base URL of the server
-                base_url = request.host_url
-                # Post request to shutdown the app with app_id
-                shutdown_url = f"{base_url}apps/shutdown"
-                msg={"command":"remove iframe","src":f"{self.app.get_relative_path('')}"}
-                self.controller.publish(self.publisher, json.dumps(msg))
-                response = requests.post(shutdown_url, data={'app_id': app_id})
-                print(f"Shutdown response: {response.text}")
-            else:
-                print("App ID not found")
-
-        
-        
 
 # Example usage
 if __name__ == "__main__":
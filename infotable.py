@@ -1,5 +1,5 @@
 import plotly.express as px
-from dash import Dash, dash_table, dcc, html, Input, Output, State, callback_context
+from dash import Dash, dash_table, dcc, html, Input, Output, State, callback_context, no_update
 import numpy as np
 import pandas as pd
 import threading
@@ -27,8 +27,13 @@ class InfoTable:
             "Pixel size (um)": "process_pixel"
         }
 
+        # Version of the table, bumped whenever self.df changes
+        # The clients check it every 2.5 seconds and only receive the table when they are not up to date
+        self.version = 0
+
         # Create the default DataFrame and table layout
         self.df = self.create_default_df()
+        self.options = self.get_options()
         self.create_table()
 
     def create_default_df(self):
@@ -41,17 +46,27 @@ class InfoTable:
     def reset_df(self):
         # Reset the DataFrame to the default state
         self.df = self.create_default_df()
+        self.version += 1
 
     def load_df(self, df):
         # Load a new DataFrame and update the table
         self.df_parent = df
-        self.df = self.create_default_df()
+        df = self.create_default_df()
 
         for row in self.default_rows:
             if row == "Number of objects":
-                self.df.loc[self.df['Project Information'] == row, 'Value'] = len(self.df_parent)
+                df.loc[df['Project Information'] == row, 'Value'] = len(self.df_parent)
             elif self.default_rows[row] in self.df_parent.columns:
-                self.df.loc[self.df['Project Information'] == row, 'Value'] = self.df_parent[self.default_rows[row]].values[0]
+                df.loc[df['Project Information'] == row, 'Value'] = self.df_parent[self.default_rows[row]].values[0]
+
+        # The table is replaced once complete, the dropdown options only change with the dataset
+        self.df = df
+        self.options = self.get_options()
+        self.version += 1
+
+    def get_options(self):
+        # Get the options for the dropdown menu
+        return [{'label': col, 'value': col} for col in self.df_parent.columns if 'sample' in col or 'acq' in col]
 
     def create_layout(self):
         # Create the layout for the Dash app
@@ -76,7 +91,8 @@ class InfoTable:
         )
 
         layout = html.Div([
-            dcc.Interval(id='interval', interval=2500, n_intervals=0),  # refresh the table every 2.5 seconds
+            dcc.Interval(id='interval', interval=2500, n_intervals=0),  # check for a new version of the table every 2.5 seconds
+            dcc.Store(id='table-version', data=self.version),
             html.Div([self.data_table], style={'width': '100%'}),
             html.Div([
                 dcc.Dropdown(
@@ -101,20 +117,25 @@ class InfoTable:
 
         @self.app.callback(
             [Output('info-table', 'data', allow_duplicate=True),
-             Output('adding-rows-dropdown', 'options', allow_duplicate=True)],
+             Output('adding-rows-dropdown', 'options', allow_duplicate=True),
+             Output('table-version', 'data', allow_duplicate=True)],
             [Input('interval', 'n_intervals')],
+            [State('table-version', 'data')],
             prevent_initial_call=True
         )
-        def update_rows(n_intervals):
-            # Update the rows and options for the table
+        def update_rows(n_intervals, client_version):
+            # Update the rows and options for the table, only if they changed since the client last received them
+            version = self.version
+            if client_version == version:
+                return no_update, no_update, no_update
             rows = self.df.to_dict('records')
-            options = [{'label': col, 'value': col} for col in self.df_parent.columns if 'sample' in col or 'acq' in col]
-            return rows, options
+            return rows, self.options, version
 
         @self.app.callback(
             [Output('info-table', 'columns'),
              Output('info-table', 'data'),
-             Output('adding-rows-dropdown', 'options')],
+             Output('adding-rows-dropdown', 'options'),
+             Output('table-version', 'data')],
             [Input('adding-rows-button', 'n_clicks')],
             [State('info-table', 'data'),
              State('info-table', 'columns'),
@@ -132,14 +153,14 @@ class InfoTable:
                 new_row = {"Project Information": row_name, "Value": self.df_parent[row_to_add][1] if len(self.df_parent[row_to_add]) >= 1 else None}
 
                 rows.append(new_row)
-                options = [{'label': col, 'value': col} for col in self.df_parent.columns if 'sample' in col or 'acq' in col]
 
                 # Adding to the df
                 self.df = pd.DataFrame(rows)
+                self.version += 1
 
-                return columns, rows, options
+                return columns, rows, self.options, self.version
 
-            return columns, rows, self.metadatas_options
+            return columns, rows, self.metadatas_options, no_update
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+from dash import Dash, dcc, html, Input, Output, MATCH, ctx, no_update
+import re
+import threading
+import time
+
+import scatter_plot as sp
+
+
+class PlotSlot:
+    def __init__(self, app_id, base_path, default_layout):
+        # Stands for a Dash app for the plot classes: they set its layout and plot like they do on the apps of the pool
+        # The plot is displayed by the multiplexed app at base_path
+        self.app_id = app_id
+        self.base_path = base_path
+        self.default_layout = default_layout
+        self.plot = None
+        self._layout = default_layout
+        self.scatter_callbacks = True  # The multiplexed app has its own scatter plot callbacks
+
+    @property
+    def layout(self):
+        return self._layout
+
+    @layout.setter
+    def layout(self, layout):
+        # The component ids of the plot become pattern-matching ids carrying the plot id,
+        # so one set of callbacks serves every plot
+        if layout is not self.default_layout:
+            for component in [layout, *layout._traverse()]:
+                if isinstance(getattr(component, 'id', None), str):
+                    component.id = {'type': component.id, 'plot': self.app_id}
+        self._layout = layout
+
+    def get_relative_path(self, path):
+        return self.base_path + path.lstrip('/')
+
+
+class MultiplexedApp:
+    def __init__(self, flask_server, size=20, on_release=None):
+        # A single Dash app displaying every plot at /plots/<plot id>/, instead of one Dash app per plot
+        # A page of the app loads the Dash bundle once and renders the plot of its URL, kept in a server-side registry
+        # At most size plots are kept, the least recently used is evicted when a new one is created
+        self.size = size
+        self.on_release = on_release
+        self.default_layout = flask_server.default_layout
+
+        self.slots = {}  # Plot id to PlotSlot
+        self.last_access = {}
+        self.building = set()  # Plots whose layout is being built, not evicted until ready or release
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        self.app = Dash(
+            "plots",
+            server=flask_server.server,
+            url_base_pathname='/plots/',
+            suppress_callback_exceptions=True  # The plot components are only in the layout returned by the router
+        )
+        self.app.layout = html.Div([
+            dcc.Location(id='url'),
+            html.Div(id='plot-container', style={'position': 'relative', 'width': '100%', 'height': '100%'})
+        ])
+        self.register_callbacks()
+
+    def get_available_app(self):
+        # Create the slot of a new plot, evicting the least recently used plot if there are too many
+        evicted = None
+        with self.lock:
+            candidates = [i for i in self.slots if i not in self.building]
+            if len(self.slots) >= self.size and candidates:
+                i = min(candidates, key=lambda i: self.last_access.get(i, 0))
+                evicted = self.slots.pop(i)
+                print(f"Evicting plot {i}")
+            slot = PlotSlot(self.next_id, f"/plots/{self.next_id}/", self.default_layout)
+            self.slots[slot.app_id] = slot
+            self.building.add(slot.app_id)
+            self.last_access[slot.app_id] = time.monotonic()
+            self.next_id += 1
+
+        if evicted is not None and self.on_release is not None:
+            self.on_release(evicted)
+        return slot
+
+    def ready(self, app_id):
+        # The layout of the plot is built, it can be evicted again
+        with self.lock:
+            self.building.discard(app_id)
+
+    def release(self, app_id):
+        # Remove a plot from the registry, return False if it is unknown
+        with self.lock:
+            self.last_access.pop(app_id, None)
+            self.building.discard(app_id)
+            return self.slots.pop(app_id, None) is not None
+
+    def release_all(self):
+        # Remove every plot from the registry and return their slots
+        with self.lock:
+            slots = list(self.slots.values())
+            self.slots.clear()
+            self.last_access.clear()
+            self.building.clear()
+        return slots
+
+    def plot_of(self, component_id):
+        # Plot displayed by the page of a pattern-matching component id
+        slot = self.slots.get(component_id['plot'])
+        if slot is None:
+            return None
+        self.last_access[slot.app_id] = time.monotonic()
+        return slot.plot
+
+    def register_callbacks(self):
+        @self.app.callback(
+            Output('plot-container', 'children'),
+            Input('url', 'pathname')
+        )
+        def route(pathname):
+            # Render the plot of the URL
+            match = re.match(r'/plots/(\d+)', pathname or '')
+            slot = self.slots.get(int(match.group(1))) if match else None
+            if slot is None:
+                return self.default_layout
+            self.last_access[slot.app_id] = time.monotonic()
+            return slot.layout
+
+        @self.app.callback(
+            Output({'type': 'graph-tooltip-2', 'plot': MATCH}, 'show'),
+            Output({'type': 'graph-tooltip-2', 'plot': MATCH}, 'bbox'),
+            Output({'type': 'graph-tooltip-2', 'plot': MATCH}, 'children'),
+            Output({'type': 'graph-tooltip-2', 'plot': MATCH}, 'direction'),
+            Input({'type': 'scatter-plot', 'plot': MATCH}, 'hoverData')
+        )
+        def display_hover(hoverData):
+            plot = self.plot_of(ctx.outputs_list[0]['id'])
+            if not isinstance(plot, sp.ScatterPlot):
+                return False, no_update, no_update, no_update
+            return plot.display_hover(hoverData)
+
+        @self.app.callback(
+            Output({'type': 'scatter-plot', 'plot': MATCH}, 'figure'),
+            Input({'type': 'scatter-plot', 'plot': MATCH}, 'relayoutData'),
+            prevent_initial_call=True
+        )
+        def zoom(relayoutData):
+            plot = self.plot_of(ctx.outputs_list['id'])
+            if not isinstance(plot, sp.ScatterPlot):
+                return no_update
+            return plot.zoom(relayoutData)
+
+        @self.app.callback(
+            Input({'type': 'stop-button', 'plot': MATCH}, 'n_clicks'),
+            prevent_initial_call=True
+        )
+        def shutdown(n_clicks):
+            # Close button of the plots
+            plot_id = ctx.inputs_list[0]['id']['plot']
+            print(f"Shutting down plot {plot_id}")
+            with self.lock:
+                slot = self.slots.pop(plot_id, None)
+                self.last_access.pop(plot_id, None)
+            if slot is not None and self.on_release is not None:
+                self.on_release(slot)
@@ -1,27 +1,85 @@
 import plotly.express as px
-from dash import dcc, html, Input, Output, no_update, callback
-from PIL import Image
-import io
+from dash import dcc, html, Input, Output, Patch, no_update, callback
+import numpy as np
+import pandas as pd
 import base64
-import os
-import requests
-import re
-from flask import request
-import json
-import zipfile
 
 import utils
+import thumbnails
+
+# Number of cells per axis of the grid used to downsample the points
+GRID_SIZE = 64
+
+
+def downsample(x, y, max_points, grid_size=GRID_SIZE):
+    # Return the sorted positions of at most max_points points, drawn cell by cell on a grid over the data
+    # Each cell keeps one point so isolated points stay visible, plus a share of the remaining points proportional to its
+    # density. With more occupied cells than max_points, only the max_points most populated cells keep their point
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+
+    def cell_of(values):
+        low, high = values.min(), values.max()
+        scale = grid_size / (high - low) if high > low else 0
+        return np.minimum(((values - low) * scale).astype(int), grid_size - 1)
+
+    cells = cell_of(x) * grid_size + cell_of(y)
+
+    # Shuffle (deterministically) then rank the points inside their cell
+    permutation = np.random.default_rng(0).permutation(n)
+    order = permutation[np.argsort(cells[permutation], kind='stable')]
+    sorted_cells = cells[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_cells)) + 1])
+    counts = np.diff(np.concatenate([starts, [n]]))
+    ranks = np.arange(n) - np.repeat(starts, counts)
+
+    cells_count = len(counts)
+    if cells_count >= max_points:
+        quotas = np.zeros(cells_count, dtype=int)
+        quotas[np.argsort(-counts, kind='stable')[:max_points]] = 1
+    else:
+        quotas = 1 + ((counts - 1) * (max_points - cells_count) // (n - cells_count))
+    return np.sort(order[ranks < np.repeat(quotas, counts)])
+
+
+class PointIndex:
+    def __init__(self, x, y):
+        # Spatial index of the points: positions sorted by x, the points of a window are found by binary search on x
+        self.order = np.argsort(x, kind='stable')
+        self.x = x[self.order]
+        self.y = y[self.order]
+
+    def window(self, x0, x1, y0, y1):
+        # Sorted positions of the points inside the window
+        start, stop = np.searchsorted(self.x, x0, side='left'), np.searchsorted(self.x, x1, side='right')
+        y = self.y[start:stop]
+        return np.sort(self.order[start:stop][(y >= y0) & (y <= y1)])
+
 
 class ScatterPlot:
-    def __init__(self,controller,app, df, x, y):
+    def __init__(self,controller,app, df, x, y, max_points=None, thumbnail_cache=None, thumbnail_url=None):
         self.controller = controller
         self.app=app
         self.df = df
         self.x = x
         self.y = y
 
+        # Level of detail mode for datasets with more than max_points objects (None sends every point):
+        # the points are drawn with WebGL, downsampled at the initial zoom and reloaded at full resolution for the zoomed window
+        self.max_points = max_points
+        self.lod = max_points is not None and len(df) > max_points
+        if self.lod:
+            self.init_lod()
+
         self.publisher = "visualization/chartPage"
 
+        # Cache of the thumbnails displayed on hover, shared by the scatter plots (None makes them on every hover)
+        # With thumbnail_url, a function returning the URL of a thumbnail served by the Flask server, the tooltip only
+        # references the image and the browser caches it, otherwise the image is embedded in the callback response
+        self.thumbnails = thumbnail_cache
+        self.thumbnail_url = thumbnail_url
+
         # Remove unwanted buttons from the plotly graph
         self.config = {
             'modeBarButtonsToRemove': ["select", "zoomIn", "zoomOut", "autoScale"],
@@ -30,16 +88,32 @@ class ScatterPlot:
 
         self.scatter_plot()
 
+    def init_lod(self):
+        # Keep the finite points as float arrays, index them and downsample them for the initial zoom
+        x = pd.to_numeric(self.df[self.x], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        y = pd.to_numeric(self.df[self.y], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        self.rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        self.x_values = x[self.rows]
+        self.y_values = y[self.rows]
+        self.images = self.df["img_file_name"].to_numpy(dtype=object)[self.rows]
+        self.index = PointIndex(self.x_values, self.y_values)
+        self.initial_points = downsample(self.x_values, self.y_values, self.max_points)
+        self.axis_types = {"xaxis": "linear", "yaxis": "linear"}
+        self.window = {"xaxis": (-np.inf, np.inf), "yaxis": (-np.inf, np.inf)}  # Visible range of each axis
+
     def create_scatter_fig(self):
         # Create a scatter plot figure with custom data for images
         fig = px.scatter(
-            data_frame=self.df,
+            data_frame=self.df.iloc[self.rows[self.initial_points]] if self.lod else self.df,
             x=self.x,
             y=self.y,
             custom_data=["img_file_name"],
-            title=self.df.name # Add a title to the figure
-
+            title=self.df.name, # Add a title to the figure
+            render_mode='webgl' if self.lod else 'auto'
         )
+        if self.lod:
+            # Keep the zoom of the user when the points of the window are sent
+            fig.update_layout(uirevision=True)
         fig.update_traces(mode='markers', marker_line_width=1, marker_size=8,marker_opacity=0.3, marker_color='#a3a7e4',
                           hoverinfo='none', hovertemplate=None)
 
@@ -88,12 +162,46 @@ class ScatterPlot:
                 ),
             ]
         )
-        return fig  # Return the created figure
+        return utils.compact_figure(fig)  # Return the created figure, with compact data arrays
+
+    def visible_points(self, relayoutData):
+        # Positions of the points to display after a zoom or pan, None if the visible window didn't change
+        changed = False
+        for axis in self.window:
+            if f"{axis}.type" in relayoutData:
+                self.axis_types[axis] = relayoutData[f"{axis}.type"]
+
+            if f"{axis}.autorange" in relayoutData:
+                # Back to the whole range (double click, reset axes)
+                self.window[axis] = (-np.inf, np.inf)
+                changed = True
+            elif f"{axis}.range[0]" in relayoutData or f"{axis}.range" in relayoutData:
+                low, high = relayoutData.get(f"{axis}.range") or (relayoutData[f"{axis}.range[0]"], relayoutData[f"{axis}.range[1]"])
+                if self.axis_types[axis] == "log":
+                    # The range of a log axis is given in powers of ten
+                    low, high = 10 ** low, 10 ** high
+                self.window[axis] = (min(low, high), max(low, high))
+                changed = True
+
+        if not changed:
+            return None
+        if self.window == {"xaxis": (-np.inf, np.inf), "yaxis": (-np.inf, np.inf)}:
+            return self.initial_points
+
+        points = self.index.window(*self.window["xaxis"], *self.window["yaxis"])
+        if len(points) > self.max_points:
+            points = points[downsample(self.x_values[points], self.y_values[points], self.max_points)]
+        return points
 
     def scatter_plot(self):
 
         fig = self.create_scatter_fig()  # Create scatter plot figure
 
+        # The callbacks are registered once per app and run the methods of the plot displayed by the app
+        self.app.plot = self
+        if not getattr(self.app, 'scatter_callbacks', False):
+            register_callbacks(self.app)
+
         self.app.layout = html.Div([
             dcc.Graph(id='scatter-plot', figure=fig, config=self.config,clear_on_unhover=True),
             dcc.Tooltip(id="graph-tooltip-2", direction='bottom'),
@@ -104,91 +212,89 @@ class ScatterPlot:
             style={'position': 'relative', 'width': '100%', 'height': '100%'}
         )
 
-        @self.app.callback(
-            Output("graph-tooltip-2", "show"),
-            Output("graph-tooltip-2", "bbox"),
-            Output("graph-tooltip-2", "children"),
-            Output("graph-tooltip-2", "direction"),
-            Input("scatter-plot", "hoverData"), 
-        )
-        def display_hover(hoverData):
-            # Display the tooltip with image on hover
-
-            if hoverData is None:
-                print("No hover data")
-                return False, no_update, no_update, no_update
-
-            pt = hoverData["points"][0]
-            img_file_name = pt["customdata"][0]
-            print(f"Hover data received: {img_file_name}")
-
-            if(self.df.zip==False):
-                # Load image with pillow
-                image_path = os.path.dirname(self.df.path) + "/" + img_file_name
-
-                try:
-                    im = Image.open(image_path)
-                    buffer = io.BytesIO()
-                    im.save(buffer, format="jpeg")
-                    encoded_image = base64.b64encode(buffer.getvalue()).decode()
-                    im_url = "data:image/jpeg;base64," + encoded_image
-                except Exception as e:
-                    print(f"Error loading image: {e}")
-                    return False, no_update, no_update, no_update
-            else:
-                # Load image from zip
-                try:
-                    zip_path, inner_path = self.df.path.split('zip:', 1)
-                    zip_path=zip_path+'zip'
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        with zip_ref.open(img_file_name) as file:
-                            im = Image.open(file)
-                            buffer = io.BytesIO()
-                            im.save(buffer, format="jpeg")
-                            encoded_image = base64.b64encode(buffer.getvalue()).decode()
-                            im_url = "data:image/jpeg;base64," + encoded_image
-                except Exception as e:
-                    print(f"Error loading image from ZIP: {e}")
-                    return False, no_update, no_update, no_update
-
-            hover_data = hoverData["points"][0]
-            bbox = hover_data["bbox"]
-
-            y = hover_data["y"]
-            direction = "bottom" if y > 1.5 else "top"
-
-            children = [
-                html.Img(
-                    src=im_url,
-                    style={"width": "150px"},
-                ),
-                html.P(img_file_name),
-            ]
+    def display_hover(self, hoverData):
+        # Display the tooltip with image on hover
 
-            return True, bbox, children, direction
-        
+        if hoverData is None:
+            print("No hover data")
+            return False, no_update, no_update, no_update
 
+        pt = hoverData["points"][0]
+        img_file_name = pt["customdata"][0]
+        print(f"Hover data received: {img_file_name}")
 
-        @self.app.callback(
-        Input('stop-button', 'n_clicks')
-        )
-        def shutdown(n_clicks):
-
-            # Use regular expression to find app_id
-            match = re.search(r'.*(\d+)/', self.app.config['requests_pathname_prefix'])
-            if match:
-                app_id = match.group(1)
-                print(f"Shutting down app {app_id}")
-                # Get the base URL of the server
-                base_url = request.host_url
-                # Post request to shutdown the app with app_id
-                shutdown_url = f"{base_url}apps/shutdown"
-                msg={"command":"remove iframe","src":f"{self.app.get_relative_path('')}"}
-                self.controller.publish(self.publisher, json.dumps(msg))
-                response = requests.post(shutdown_url, data={'app_id': app_id})
-                print(f"Shutdown response: {response.text}")
+        # Load the thumbnail of the image, from the cache if it was already displayed
+        try:
+            if self.thumbnail_url is not None:
+                im_url = self.thumbnail_url(self.df.path, img_file_name)
+            elif self.thumbnails is not None:
+                thumbnail = self.thumbnails.get(self.df.path, img_file_name)
+                print(f"Thumbnail cache: {self.thumbnails.stats()}")
+                im_url = "data:image/jpeg;base64," + base64.b64encode(thumbnail).decode()
             else:
-                print("App ID not found")
+                thumbnail = thumbnails.make_thumbnail(self.df.path, img_file_name)
+                im_url = "data:image/jpeg;base64," + base64.b64encode(thumbnail).decode()
+        except Exception as e:
+            print(f"Error loading image: {e}")
+            return False, no_update, no_update, no_update
+
+        hover_data = hoverData["points"][0]
+        bbox = hover_data["bbox"]
+
+        y = hover_data["y"]
+        direction = "bottom" if y > 1.5 else "top"
+
+        children = [
+            html.Img(
+                src=im_url,
+                style={"width": "150px"},
+            ),
+            html.P(img_file_name),
+        ]
+
+        return True, bbox, children, direction
+
+    def zoom(self, relayoutData):
+        # Send the points of the visible window, at full resolution if there are few enough of them
+        if not self.lod:
+            return no_update
+        points = self.visible_points(relayoutData or {})
+        if points is None:
+            return no_update
+
+        patch = Patch()
+        patch['data'][0]['x'] = utils.compact_array(self.x_values[points])
+        patch['data'][0]['y'] = utils.compact_array(self.y_values[points])
+        patch['data'][0]['customdata'] = self.images[points].reshape(-1, 1)
+        return patch
+
+
+def register_callbacks(app):
+    # Callback templates of the scatter plots, registered once on an app and reused by every scatter plot it displays
+    # The Flask server registers them on every app of its pool, the close button is one of its own templates
+    app.scatter_callbacks = True
+
+    @app.callback(
+        Output("graph-tooltip-2", "show"),
+        Output("graph-tooltip-2", "bbox"),
+        Output("graph-tooltip-2", "children"),
+        Output("graph-tooltip-2", "direction"),
+        Input("scatter-plot", "hoverData"),
+    )
+    def display_hover(hoverData):
+        if not isinstance(app.plot, ScatterPlot):
+            return False, no_update, no_update, no_update
+        return app.plot.display_hover(hoverData)
+
+    @app.callback(
+        Output('scatter-plot', 'figure'),
+        Input('scatter-plot', 'relayoutData'),
+        prevent_initial_call=True
+    )
+    def zoom(relayoutData):
+        if not isinstance(app.plot, ScatterPlot):
+            return no_update
+        return app.plot.zoom(relayoutData)
 
 
 # Example usage
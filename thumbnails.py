@@ -0,0 +1,167 @@
+from PIL import Image
+import io
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from dataset_cache import source_signature
+from zip_pool import open_zip
+
+# Width in pixels of the thumbnails displayed when hovering a point
+THUMBNAIL_WIDTH = 150
+
+
+def make_thumbnail(dataset_path, img_file_name, width=THUMBNAIL_WIDTH):
+    # Open the image of an object (next to the TSV file or inside its ZIP archive) and return it as a JPEG of the given width
+    if 'zip:' in dataset_path:
+        zip_path = dataset_path.split('zip:', 1)[0] + 'zip'
+        with open_zip(zip_path) as zip_ref:
+            with zip_ref.open(img_file_name) as file:
+                with Image.open(file) as im:
+                    return encode_thumbnail(im, width)
+    else:
+        with Image.open(os.path.join(os.path.dirname(dataset_path), img_file_name)) as im:
+            return encode_thumbnail(im, width)
+
+def encode_thumbnail(im, width):
+    # Smaller images keep their size, JPEG has no alpha channel
+    im = im.convert('RGB')
+    im.thumbnail((width, im.height * width // max(im.width, 1) or 1))
+    buffer = io.BytesIO()
+    im.save(buffer, format="jpeg", quality=85)
+    return buffer.getvalue()
+
+
+class ThumbnailCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, spill_dir=None):
+        # In-memory LRU of the thumbnails, keyed by dataset path, dataset file signature and image name
+        # With spill_dir, the thumbnails evicted from memory are written there and read back on the next hover
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.last_request = 0  # time.monotonic() of the last hover, the prefetcher waits while the user is hovering
+        self.lock = threading.Lock()
+
+    def get(self, dataset_path, img_file_name, prefetch=False):
+        # Return the JPEG thumbnail of an object, making it only if it is neither in memory nor on disk
+        # The prefetched thumbnails are not counted as hits or misses
+        key = (dataset_path, tuple(source_signature(dataset_path)), img_file_name)
+
+        with self.lock:
+            if not prefetch:
+                self.last_request = time.monotonic()
+            data = self.entries.get(key)
+            if data is not None:
+                if not prefetch:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                return data
+
+        data = self.read_spilled(key)
+        if data is not None:
+            if not prefetch:
+                with self.lock:
+                    self.disk_hits += 1
+        else:
+            data = make_thumbnail(dataset_path, img_file_name)
+            with self.lock:
+                if prefetch:
+                    self.prefetched += 1
+                else:
+                    self.misses += 1
+
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        evicted = []
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.bytes += len(data)
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                evicted.append(self.entries.popitem(last=False))
+                self.bytes -= len(evicted[-1][1])
+
+        # Written outside of the lock, the other hovers don't wait for the disk
+        for evicted_key, evicted_data in evicted:
+            self.spill(evicted_key, evicted_data)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.jpg')
+
+    def read_spilled(self, key):
+        if self.spill_dir is None:
+            return None
+        try:
+            with open(self.spill_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def spill(self, key, data):
+        if self.spill_dir is None:
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = self.spill_path(key)
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Failed to spill thumbnail: {e}")
+
+    def stats(self):
+        # Counters reported in the logs
+        with self.lock:
+            requests = self.hits + self.disk_hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "prefetched": self.prefetched, "hit_rate": round((self.hits + self.disk_hits) / requests, 3) if requests else None}
+
+
+class ThumbnailPrefetcher(threading.Thread):
+    def __init__(self, thumbnail_cache, dataset_path, img_file_names, delay=0.05, idle=1.0, max_fill=0.75):
+        # Make the thumbnails of a loaded dataset in the background so the first hover of a point is a cache hit
+        # One thumbnail every delay seconds at most, and none while a thumbnail was requested less than idle seconds ago
+        # so the hovers and the other callbacks keep the CPU. It stops once the cache is max_fill full, the prefetched
+        # thumbnails never evict the hovered ones
+        super().__init__(daemon=True)
+        self.cache = thumbnail_cache
+        self.dataset_path = dataset_path
+        self.img_file_names = img_file_names
+        self.delay = delay
+        self.idle = idle
+        self.max_fill = max_fill
+        self.stop_event = threading.Event()
+
+    def run(self):
+        count = 0
+        for img_file_name in self.img_file_names:
+            # Wait for the user to stop hovering
+            while not self.stop_event.is_set() and time.monotonic() - self.cache.last_request < self.idle:
+                self.stop_event.wait(self.idle)
+            if self.stop_event.is_set():
+                print(f"Thumbnail prefetch of {self.dataset_path} cancelled after {count} thumbnails")
+                return
+            if self.cache.bytes >= self.max_fill * self.cache.max_bytes:
+                break
+
+            try:
+                self.cache.get(self.dataset_path, img_file_name, prefetch=True)
+                count += 1
+            except Exception as e:
+                print(f"Failed to prefetch thumbnail {img_file_name}: {e}")
+            self.stop_event.wait(self.delay)
+
+        print(f"Prefetched {count} thumbnails of {self.dataset_path}")
+
+    def stop(self):
+        self.stop_event.set()
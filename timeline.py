@@ -1,14 +1,14 @@
 import plotly.express as px
-from dash import Dash, dcc, html, Input, Output
-import os
-import pandas as pd
+import plotly.graph_objects as go
+from dash import Dash, dcc, html, Input, Output, State, Patch, no_update
 from flask import request
 
 import utils as utils
+import catalog
 
 
 class Timeline:
-    def __init__(self,controller,app):
+    def __init__(self,controller,app, sample_catalog=None):
         self.controller = controller
         self.app=app
 
@@ -17,69 +17,20 @@ class Timeline:
         self.x='date'
         self.y='Objects/ml'
 
-        # Reading data from a JSON file
-        data_path = os.path.join('..', 'data/export/')
-        self.df = self.create_df(data_path)
+        # Reading the per-sample table from the catalog shared with the other views
+        # The timeline is notified when samples are added, changed or removed
+        self.catalog = sample_catalog if sample_catalog is not None else catalog.SampleCatalog()
+        self.catalog.subscribe(self.update_df)
+        self.df = self.catalog.get_df()
+
+        # The clients receive the samples added, changed or removed since their version of the timeline
+        self.refresh = catalog.CatalogRefresh('hist-plot')
 
         # Hidding the mode bar
         self.config = {'displayModeBar': False}
         
         self.timeline_plot()
 
-    def create_df(self, path):
-        # Method to create a DataFrame from TSV files in a directory
-        columns = ['filename', 'Objects/ml', 'date', 'lat', 'lon']
-        df = pd.DataFrame(columns=columns)
-        tsvs = utils.find_tsv_files(path)
-
-
-        # Helper function to extract a value or return a default if not available
-        def get_value(df, column, default=1):
-            if column in df.columns and not df[column].empty:
-                try:
-                    value = float(df[column].iloc[0])
-                    return value if value else default
-                except (ValueError, TypeError):
-                    return default
-            return default
-
-        data_list = []
-
-        # Iterating over the TSV files to extract data
-        for tsv in tsvs:
-            df_temp, nb_objects, metadatas = utils.load_dataframe(tsv)
-            
-            acq_imaged_volume = get_value(df_temp, "acq_imaged_volume")
-            sample_dilution_factor = get_value(df_temp, "sample_dilution_factor")
-            sample_concentrated_sample_volume = get_value(df_temp, "sample_concentrated_sample_volume")
-            sample_total_volume = get_value(df_temp, "sample_total_volume")
-
-            filename=os.path.basename(tsv)
-            filename=filename.split("zip:")[-1]
-
-            data = {
-                "filename": filename,
-                "Objects/ml": (nb_objects / acq_imaged_volume) * sample_dilution_factor * (sample_concentrated_sample_volume / (sample_total_volume * 1000)),
-                "date": df_temp["acq_local_datetime"].iloc[0] if "acq_local_datetime" in df_temp.columns and not df_temp["acq_local_datetime"].empty else None,
-                "lat": df_temp["object_lat"].iloc[0] if "object_lat" in df_temp.columns and not df_temp["object_lat"].empty else None,
-                "lon": df_temp["object_lon"].iloc[0] if "object_lon" in df_temp.columns and not df_temp["object_lon"].empty else None
-            }
-            data_list.append(data)
-
-        # delete duplicates
-        data_list = [i for n, i in enumerate(data_list) if i not in data_list[n + 1:]]
-        
-        df = pd.concat([df, pd.DataFrame(data_list)], ignore_index=True)
-
-        
-                
-
-        # Transform the 'date' column to datetime format
-        df['date'] = pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.strftime('%Y-%m-%d')
-
-        return df
-
     def create_timeline_fig(self):
         # Create a Plotly Express histogram
         fig = px.bar(
@@ -96,26 +47,69 @@ class Timeline:
             width=None,
             showlegend=False           
         )
-        color=len(self.df)*['#a3a7e4']
-        fig.update_traces(marker=dict(color=color))
-
-        return fig
+        # One color for every bar, there is one trace per sample
+        fig.update_traces(marker=dict(color='#a3a7e4'))
+
+        return utils.compact_figure(fig)
+
+    def update_df(self, df, added, changed, removed):
+        # Called by the catalog when samples are added, changed or removed
+        self.df = df
+        fig = self.create_timeline_fig()
+        traces = {trace.name: trace for trace in fig.data}
+
+        # There is one bar trace per sample, only the traces of the affected samples are sent
+        # They are kept in the order already displayed by the clients
+        names = [trace.name for trace in self.fig.data]
+        patch = Patch()
+        for filename in removed:
+            if filename in names:
+                del patch['data'][names.index(filename)]
+                names.remove(filename)
+        for filename in changed:
+            if filename in names and filename in traces:
+                patch['data'][names.index(filename)] = traces[filename].to_plotly_json()
+        for filename in added:
+            if filename in traces and filename not in names:
+                patch['data'].append(traces[filename].to_plotly_json())
+                names.append(filename)
+
+        if set(names) != set(traces):
+            # The displayed traces can't be matched with the samples, the clients will get the whole figure
+            self.fig = fig
+            patch = None
+        else:
+            self.fig = go.Figure(data=[traces[name] for name in names], layout=fig.layout)
+        self.refresh.push(self.fig, patch)
 
     def timeline_plot(self):
         self.fig = self.create_timeline_fig()
+        self.refresh.push(self.fig, None)
+
+        # The layout is built for each page, with the timeline of the current samples
+        self.app.layout = self.layout
 
-        self.app.layout = html.Div([
-            dcc.Graph(id='hist-plot', figure=self.fig,config=self.config),
+        self.register_callbacks()
+
+    def layout(self):
+        fig, version = self.refresh.current()
+        return html.Div([
+            dcc.Graph(id='hist-plot', figure=fig,config=self.config),
+            *self.refresh.components(version)
         ],
             style={'position': 'relative', 'width': '100%', 'height': '100%'}
         )
 
+    def register_callbacks(self):
         #Dataset selection callback
         @self.app.callback(
             Output('hist-plot','figure'),
-            Input('hist-plot', 'clickData')
+            Output('catalog-version', 'data'),
+            Input('hist-plot', 'clickData'),
+            State('catalog-version', 'data'),
+            prevent_initial_call=True
         )
-        def select_bar(clickData):
+        def select_bar(clickData, client_version):
                 
             if clickData is not None:
 
@@ -132,7 +126,12 @@ class Timeline:
                 filename = selected_bar['customdata'][0]
                 self.controller.publish(self.publisher, filename)
 
-            return self.fig
+            # The figure doesn't change, it is only sent to a client missing samples
+            if client_version != self.refresh.version:
+                return self.fig, self.refresh.version
+            return no_update, no_update
+
+        self.refresh.register_callbacks(self.app)
 
 # Example usage
 if __name__ == "__main__":
@@ -1,34 +1,214 @@
 
 import os
+import io
+import numpy as np
 import pandas as pd
 import zipfile
+from contextlib import contextmanager
+
+from zip_pool import open_zip
+
+# In compact mode the text columns that barely repeat are stored in Arrow buffers (a few bytes over the length of each
+# string) instead of one Python object per row, which needs pyarrow
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# A text column is held as a category when it has fewer distinct values than this ratio of its rows
+CATEGORY_MAX_RATIO = 0.5
+
+# A float array of a figure is sent as float32 when its largest magnitude is below this ratio of its range, so the
+# rounding of the 24-bit float32 mantissa stays under 1/10000 of the range, finer than any plot can display
+FLOAT32_MAX_RATIO = 2 ** 24 / 10000
+
+# Data arrays of the figure traces made compact by compact_figure
+FIGURE_ARRAYS = ['x', 'y', 'z', 'lat', 'lon', 'width', 'base', 'customdata']
 
 def find_tsv_files(path):
-    # Initialize an empty list to store the paths of TSV files
-    tsv_files = []
+    # Return only the paths of the TSV files found under path
+    return [tsv for tsv, signature in find_tsv_entries(path)]
+
+def find_tsv_entries(path, archives=None):
+    # Initialize an empty list to store the (path, signature) of TSV files
+    # The signature is [size, mtime, crc] and changes whenever the file content may have changed
+    # archives maps each ZIP path to its [size, mtime] and its TSV entries from a previous scan, an archive that didn't
+    # change is not opened again (a corrupt one is not logged again), the dict is updated with this scan
+    tsv_entries = []
+    if archives is None:
+        archives = {}
+    seen = set()
     
     # Iterate through the directory tree
     for root, dirs, files in os.walk(path):
         for file in files:
             # Check if the file is a TSV file
             if file.endswith('.tsv'):
-                # Add the path of the TSV file to the list
-                tsv_files.append(os.path.join(root, file))
+                # Add the path of the TSV file to the list with its size and modification time
+                tsv_path = os.path.join(root, file)
+                stat = os.stat(tsv_path)
+                tsv_entries.append((tsv_path, [stat.st_size, stat.st_mtime, None]))
 
             if file.endswith('.zip'):
-                # explore the zip file
-                with zipfile.ZipFile(os.path.join(root, file), 'r') as zip_ref:
-                    for inner_file in zip_ref.namelist():
-                        if inner_file.endswith('.tsv'):
-                            # Add the path of the TSV file to the list
-                            tsv_files.append(os.path.join(root, file) + ':' + inner_file)
-    
-    return tsv_files
+                zip_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(zip_path)
+                except OSError:
+                    continue
+                seen.add(zip_path)
+                signature = [stat.st_size, stat.st_mtime]
+                archive = archives.get(zip_path)
+                if archive is None or archive["signature"] != signature:
+                    archive = {"signature": signature, "entries": list_zip_tsvs(zip_path)}
+                    archives[zip_path] = archive
+                tsv_entries.extend((tsv, tsv_signature) for tsv, tsv_signature in archive["entries"])
+
+    # Archives removed from the directory are forgotten
+    for zip_path in [zip_path for zip_path in archives if zip_path not in seen]:
+        del archives[zip_path]
+
+    return tsv_entries
+
+def list_zip_tsvs(zip_path):
+    # explore the zip file, a corrupt archive is skipped instead of aborting the whole scan
+    entries = []
+    try:
+        with open_zip(zip_path) as zip_ref:
+            for info in zip_ref.infolist():
+                if info.filename.endswith('.tsv'):
+                    # Add the path of the TSV file to the list, the member CRC identifies its content
+                    entries.append([zip_path + ':' + info.filename, [info.file_size, list(info.date_time), info.CRC]])
+    except (zipfile.BadZipFile, OSError) as e:
+        print(f"Skipping {zip_path}: {e}")
+    return entries
+
+def load_dataframe(path, compact=False):
+    # Read the header and the [t]/[f] type row first to know the dtype of each column
+    # With compact, the DataFrame is shrunk by compact_dataframe once loaded
+    with open_tsv(path) as file:
+        types = read_types(file)
+
+    # [f] columns are parsed as floats and [t] columns as categories, the type row is skipped
+    # so the whole table is parsed in one pass without any intermediate object column
+    dtype = {col: 'float64' if types[col] == '[f]' else 'category' for col in types.index}
+    df = CustomDataFrame(path=path, skiprows=[1], dtype=dtype)
+
+    # Text columns that barely repeat (file names, object ids...) take less memory as plain strings
+    for col in types.index:
+        if types[col] != '[f]' and len(df[col].cat.categories) > CATEGORY_MAX_RATIO * len(df):
+            df[col] = df[col].astype(object)
 
-def load_dataframe(path):
-    # Initialize a CustomDataFrame object with the path
-    df = CustomDataFrame(path=path)
-    
+    # To lower case all column names
+    df.columns = df.columns.str.lower()
+    types.index = types.index.str.lower()
+
+    # Rows are numbered from 1 as the row 0 was the type row
+    df.index = pd.RangeIndex(1, len(df) + 1)
+
+    # Add the numeric columns to the list of metadatas of interest if they contain 'object_', but not 'id' or 'label'
+    metadatas_of_interest = [col for col in df.columns
+                             if types[col] == '[f]' and "object_" in col and "id" not in col and "label" not in col]
+
+    if compact:
+        df = compact_dataframe(df)
+
+    return df, len(df), metadatas_of_interest
+
+def arrow_string_dtype():
+    # Arrow string dtype whose missing values are NaN like in the object columns (pandas >= 2.3), None without pyarrow
+    if pyarrow is None:
+        return None
+    try:
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except TypeError:
+        return pd.StringDtype('pyarrow')
+
+def compact_dataframe(df):
+    # Shrink the memory used by a loaded DataFrame, the columns keep their names and values
+    string_dtype = arrow_string_dtype()
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]) and len(df) > 1 and df[col].nunique(dropna=False) == 1:
+            # Per-sample constants (sample_, acq_, process_ columns, object_lat...) are stored once as a single category
+            df[col] = df[col].astype('category')
+        elif col.startswith('object_') and pd.api.types.is_float_dtype(df[col]):
+            # Object measurements don't need more than float32 precision
+            df[col] = df[col].astype('float32')
+        elif df[col].dtype == object and string_dtype is not None:
+            # File names and object ids, unique per object, are the largest columns of an export
+            df[col] = df[col].astype(string_dtype)
+
+    return df
+
+def compact_array(values):
+    # Array taking fewer bytes in a figure (plotly sends the NumPy arrays as base64 typed arrays): float64 becomes float32
+    # where the precision allows it and int64 becomes int32 when the values fit, any other value is returned unchanged
+    if not isinstance(values, np.ndarray) or not values.size:
+        return values
+    if values.dtype == np.float64:
+        finite = values[np.isfinite(values)]
+        if len(finite):
+            magnitude = np.abs(finite).max()
+            span = finite.max() - finite.min()
+            if span > 0 and magnitude > span * FLOAT32_MAX_RATIO:
+                return values
+        return values.astype(np.float32)
+    if values.dtype == np.int64:
+        info = np.iinfo(np.int32)
+        if info.min <= values.min() and values.max() <= info.max:
+            return values.astype(np.int32)
+    return values
+
+def compact_figure(fig):
+    # Make the data arrays of every trace compact, the figure is changed in place and returned
+    for trace in fig.data:
+        for prop in FIGURE_ARRAYS:
+            if prop in trace:
+                set_compact(trace, prop)
+        if 'marker' in trace:
+            for prop in ['color', 'size']:
+                if prop in trace.marker:
+                    set_compact(trace.marker, prop)
+    return fig
+
+def set_compact(obj, prop):
+    values = obj[prop]
+    if isinstance(values, np.ndarray):
+        compact = compact_array(values)
+        if compact is not values:
+            # plotly ignores an assignment equal to the current value, whatever the dtype
+            obj[prop] = None
+            obj[prop] = compact
+
+def read_types(file):
+    # Parse the header and the type row of an open TSV file, return the type ('[t]' or '[f]') of each column
+    head = file.readline() + file.readline()
+    return pd.read_csv(io.BytesIO(head), sep='\t', dtype=str).iloc[0]
+
+def load_metadata(path):
+    # Same result as load_dataframe but the DataFrame only holds the first object
+    # Only the two header lines and the first data line are parsed, the other lines are just counted
+    with open_tsv(path) as file:
+        head = [file.readline() for _ in range(3)]
+
+        # Count the remaining lines without tokenizing them
+        number_of_object = head[2].count(b'\n')
+        last = head[2]
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            number_of_object += chunk.count(b'\n')
+            last = chunk
+        # The last line may not end with a newline
+        if last and not last.endswith(b'\n'):
+            number_of_object += 1
+
+    df = CustomDataFrame(pd.read_csv(io.BytesIO(b''.join(head)), sep='\t'))
+    df.path = path
+    df.name = os.path.basename(path)
+    df.zip = 'zip:' in path
+
+    df, _, metadatas_of_interest = apply_types(df)
+    return df, number_of_object, metadatas_of_interest
+
+def apply_types(df):
     # To lower case all column names
     df.columns = df.columns.str.lower()
     
@@ -51,6 +231,19 @@ def load_dataframe(path):
 
     return df, len(df), metadatas_of_interest
 
+@contextmanager
+def open_tsv(path):
+    # Open a TSV file in binary mode, directly or from inside a ZIP archive
+    if 'zip:' in path:
+        zip_path, inner_path = path.split('zip:', 1)
+        zip_path=zip_path+'zip'
+        with open_zip(zip_path) as zip_ref:
+            with zip_ref.open(inner_path) as file:
+                yield file
+    else:
+        with open(path, 'rb') as file:
+            yield file
+
 class CustomDataFrame(pd.DataFrame):
     _metadata = ['path', 'name','zip']
     
@@ -59,7 +252,7 @@ class CustomDataFrame(pd.DataFrame):
             if 'zip:' in path:
                 zip_path, inner_path = path.split('zip:', 1)
                 zip_path=zip_path+'zip'
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                with open_zip(zip_path) as zip_ref:
                     with zip_ref.open(inner_path) as file:
                         # Read the TSV file from the ZIP archive
                         super().__init__(pd.read_csv(file, sep='\t', *args, **kwargs))
@@ -1,16 +1,15 @@
 # Importing necessary libraries for data visualization, web application development, data manipulation, and threading
 import plotly.express as px
-from dash import Dash, dcc, html, Input, Output, no_update, callback
-import pandas as pd
-import os
+from dash import Dash, dcc, html, Input, Output, State, Patch, no_update, callback
 import paho.mqtt.client as mqtt
 
 # Importing a custom utility module
 import utils
+import catalog
 
 # Definition of the WorldMap class
 class WorldMap:
-    def __init__(self, controller,app):
+    def __init__(self, controller,app, sample_catalog=None):
         # Initialization method with a controller parameter for external interactions
         self.controller = controller
         self.app = app
@@ -19,9 +18,14 @@ class WorldMap:
         self.publisher = "visualization/dataset"
        
 
-        # Reading data from a JSON file
-        data_path = os.path.join('..', 'data/export/')
-        self.df = self.create_df(data_path)
+        # Reading the per-sample table from the catalog shared with the other views
+        # The map is notified when samples are added, changed or removed
+        self.catalog = sample_catalog if sample_catalog is not None else catalog.SampleCatalog()
+        self.catalog.subscribe(self.update_df)
+        self.df = self.catalog.get_df()
+
+        # The clients receive the samples added, changed or removed since their version of the map
+        self.refresh = catalog.CatalogRefresh('world-map')
 
         # Hidding the mode bar
         self.config = {'displayModeBar': False}
@@ -30,61 +34,6 @@ class WorldMap:
         self.world_map()
 
 
-    def create_df(self, path):
-        # Method to create a DataFrame from TSV files in a directory
-        columns = ['filename', 'Objects/ml', 'date', 'lat', 'lon']
-        df = pd.DataFrame(columns=columns)
-        tsvs = utils.find_tsv_files(path)
-
-
-
-        # Helper function to extract a value or return a default if not available
-        def get_value(df, column, default=1):
-            if column in df.columns and not df[column].empty:
-                try:
-                    value = float(df[column].iloc[0])
-                    return value if value else default
-                except (ValueError, TypeError):
-                    return default
-            return default
-
-        data_list = []
-
-        # Iterating over the TSV files to extract data
-        for tsv in tsvs:
-            df_temp, nb_objects, metadatas = utils.load_dataframe(tsv)
-            
-            acq_imaged_volume = get_value(df_temp, "acq_imaged_volume")
-            sample_dilution_factor = get_value(df_temp, "sample_dilution_factor")
-            sample_concentrated_sample_volume = get_value(df_temp, "sample_concentrated_sample_volume")
-            sample_total_volume = get_value(df_temp, "sample_total_volume")
-
-            filename=os.path.basename(tsv)
-            filename=filename.split("zip:")[-1]
-
-            data = {
-                "filename": filename,
-                "Objects/ml": (nb_objects / acq_imaged_volume) * sample_dilution_factor * (sample_concentrated_sample_volume / (sample_total_volume * 1000)),
-                "date": df_temp["acq_local_datetime"].iloc[0] if "acq_local_datetime" in df_temp.columns and not df_temp["acq_local_datetime"].empty else None,
-                "lat": df_temp["object_lat"].iloc[0] if "object_lat" in df_temp.columns and not df_temp["object_lat"].empty else None,
-                "lon": df_temp["object_lon"].iloc[0] if "object_lon" in df_temp.columns and not df_temp["object_lon"].empty else None
-            }
-            data_list.append(data)
-        
-        # delete duplicates
-        data_list = [i for n, i in enumerate(data_list) if i not in data_list[n + 1:]]
-
-        df = pd.concat([df, pd.DataFrame(data_list)], ignore_index=True)
-
-        
-                
-
-        # Transform the 'date' column to datetime format
-        df['date'] = pd.to_datetime(df['date'])
-        df['date'] = df['date'].dt.strftime('%Y-%m-%d')
-
-        return df
-
     def create_world_map_fig(self):
         # Method to create a Plotly figure for a world map visualization
         fig = px.scatter_geo(
@@ -106,10 +55,9 @@ class WorldMap:
             width=None
         )
 
-        # Updating marker properties
-        size = [10] * len(self.df)
+        # Updating marker properties, the opacity is per sample to highlight the selected one
         opacity = [0.5] * len(self.df)
-        fig.update_traces(marker=dict(size=size, opacity=opacity))
+        fig.update_traces(marker=dict(size=10, opacity=opacity))
 
         # Adjusting color axis properties for the color bar
         fig.update_coloraxes(colorbar=dict(
@@ -119,17 +67,43 @@ class WorldMap:
             y=0.5,  # Vertically positioning at the middle
         ))
 
-        return fig
+        return utils.compact_figure(fig)
+
+    def update_df(self, df, added, changed, removed):
+        # Called by the catalog when samples are added, changed or removed
+        self.df = df
+        fig = self.create_world_map_fig()
+
+        # Only the data arrays of the trace are sent so the clients keep their view of the map
+        trace = fig.data[0]
+        patch = Patch()
+        patch['data'][0]['lat'] = trace.lat
+        patch['data'][0]['lon'] = trace.lon
+        patch['data'][0]['customdata'] = trace.customdata
+        patch['data'][0]['marker']['color'] = trace.marker.color
+        patch['data'][0]['marker']['size'] = trace.marker.size
+        patch['data'][0]['marker']['opacity'] = trace.marker.opacity
+
+        self.fig = fig
+        self.refresh.push(fig, patch)
 
     def world_map(self):
         # Method to setup and run the Dash web application
         self.fig = self.create_world_map_fig()
+        self.refresh.push(self.fig, None)
 
+        # The layout is built for each page, with the map of the current samples
+        self.app.layout = self.layout
 
+        self.register_callbacks()
+
+    def layout(self):
         # Defining the layout of the web application
-        self.app.layout = html.Div([
-            dcc.Graph(id='world-map', figure=self.fig, clear_on_unhover=True,config=self.config,
-                      style={'position': 'relative', 'flex':1})
+        fig, version = self.refresh.current()
+        return html.Div([
+            dcc.Graph(id='world-map', figure=fig, clear_on_unhover=True,config=self.config,
+                      style={'position': 'relative', 'flex':1}),
+            *self.refresh.components(version)
         ],
             style={'position': 'relative', 
                    'display': 'flex',
@@ -141,14 +115,17 @@ class WorldMap:
                    }
         )
 
+    def register_callbacks(self):
         @self.app.callback(
             Output('world-map', 'figure'),
-            Input('world-map', 'clickData')
+            Output('catalog-version', 'data'),
+            Input('world-map', 'clickData'),
+            State('catalog-version', 'data')
         )
-        def select_point(clickData):
+        def select_point(clickData, client_version):
             # Callback function to handle click events on the world map
             if clickData is None:
-                return no_update
+                return no_update, no_update
 
             # Highlighting the selected point on the world map
             selected_point = clickData['points'][0]
@@ -161,9 +138,15 @@ class WorldMap:
             
             dataset_name = selected_point['customdata'][0]
             self.controller.publish(self.publisher, dataset_name)
-                
 
-            return self.fig
+            # Only the opacities are sent, unless the client is missing samples and needs the whole figure
+            if client_version != self.refresh.version:
+                return self.fig, self.refresh.version
+            patch = Patch()
+            patch['data'][0]['marker']['opacity'] = opacity
+            return patch, no_update
+
+        self.refresh.register_callbacks(self.app)
 
        
 # Example usage section
@@ -0,0 +1,114 @@
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class ZipHandle:
+    def __init__(self, zip_file, signature):
+        # An open archive, the threads using it and whether it was removed from the pool
+        self.zip_file = zip_file
+        self.signature = signature
+        self.users = 0
+        self.retired = False
+
+
+class ZipPool:
+    def __init__(self, max_open=16):
+        # Open ZipFile handles shared by the whole process, keyed by archive path
+        # Opening an archive parses its central directory, which is slow for exports with thousands of images,
+        # so the handles are kept open and reused until the archive size or modification time changes
+        # At most max_open idle handles are kept, the least recently used are closed first
+        self.max_open = max_open
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, zip_path):
+        # Yield the open ZipFile of an archive, several threads can read its members at the same time
+        handle = self.acquire(zip_path)
+        try:
+            yield handle.zip_file
+        finally:
+            self.release(handle)
+
+    def acquire(self, zip_path):
+        stat = os.stat(zip_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            handle = self.entries.get(zip_path)
+            if handle is not None and handle.signature == signature:
+                self.entries.move_to_end(zip_path)
+                handle.users += 1
+                self.hits += 1
+                return handle
+
+        # Opened outside of the lock, the other threads don't wait for the central directory to be parsed
+        zip_file = zipfile.ZipFile(zip_path, 'r')
+
+        with self.lock:
+            handle = self.entries.get(zip_path)
+            if handle is not None and handle.signature == signature:
+                # Another thread opened it meanwhile
+                zip_file.close()
+                self.entries.move_to_end(zip_path)
+                handle.users += 1
+                self.hits += 1
+                return handle
+
+            # The archive changed since it was opened
+            if handle is not None:
+                self.retire(zip_path)
+
+            handle = ZipHandle(zip_file, signature)
+            handle.users = 1
+            self.entries[zip_path] = handle
+            self.misses += 1
+            while len(self.entries) > self.max_open:
+                self.retire(next(iter(self.entries)))
+            return handle
+
+    def release(self, handle):
+        with self.lock:
+            handle.users -= 1
+            if handle.retired and handle.users == 0:
+                handle.zip_file.close()
+
+    def retire(self, zip_path):
+        # Must be called with the lock held
+        # The handle leaves the pool, it is closed now or by the last thread still using it
+        handle = self.entries.pop(zip_path)
+        handle.retired = True
+        if handle.users == 0:
+            handle.zip_file.close()
+
+    def clear(self):
+        with self.lock:
+            for zip_path in list(self.entries):
+                self.retire(zip_path)
+
+    def reset_after_fork(self):
+        # A forked process (catalog workers) must not share the file offsets of the parent handles
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def stats(self):
+        # Counters reported in the logs
+        with self.lock:
+            return {"open": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# Pool used for every ZIP access of the project
+pool = ZipPool()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pool.reset_after_fork)
+
+
+def open_zip(zip_path):
+    # Shortcut for pool.open, used as a context manager
+    return pool.open(zip_path)